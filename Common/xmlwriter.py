@@ -0,0 +1,78 @@
+"""Streaming XML writer shared by the upgraders."""
+
+
+#Classes
+#==============================================================================
+class XMLWriter(object):
+    """An indenting XML writer. Elements are written as soon as they are
+    finished instead of building and prettifying the whole document at the
+    end. The output is the same as minidom's writexml with the same
+    indentation settings.
+    """
+    def __init__(self, f, indent = "", addindent = "", newl = ""):
+        """Setup this XML writer and write the XML declaration."""
+        self.f = f
+        self.indent = indent
+        self.addindent = addindent
+        self.newl = newl
+        self.tags = []
+        self.is_open = False
+        f.write('<?xml version="1.0" ?>' + newl)
+
+    def escape(self, value):
+        """Escape an attribute value."""
+        return (value.replace("&", "&amp;").replace("<", "&lt;")
+            .replace(">", "&gt;").replace('"', "&quot;")
+            .replace("\n", "&#10;").replace("\r", "&#13;")
+            .replace("\t", "&#09;"))
+
+    def start(self, tag, attrib = {}):
+        """Start an element. Its start tag is only closed once it has a
+        child, so elements without children are written as empty tags.
+        """
+        #Close the start tag of the parent element
+        if self.is_open:
+            self.f.write(">" + self.newl)
+
+        self.f.write("{}<{}{}".format(
+            self.indent + self.addindent * len(self.tags), tag, "".join([
+            ' {}="{}"'.format(name, self.escape(value))
+            for name, value in attrib.items()])))
+        self.tags.append(tag)
+        self.is_open = True
+
+    def end(self):
+        """End the current element."""
+        tag = self.tags.pop()
+
+        #Empty element?
+        if self.is_open:
+            self.f.write("/>" + self.newl)
+            self.is_open = False
+
+        else:
+            self.f.write("{}</{}>{}".format(
+                self.indent + self.addindent * len(self.tags), tag, self.newl))
+
+    def element(self, tag, attrib = {}):
+        """Write an element without children."""
+        self.start(tag, attrib)
+        self.end()
+
+    def write(self, elem):
+        """Write an ElementTree element and all of its children."""
+        self.start(elem.tag, elem.attrib)
+
+        for child in elem:
+            self.write(child)
+
+        self.end()
+
+    def flush(self, elem):
+        """Write the children of an ElementTree element and remove them from
+        it. The element must be the element being written.
+        """
+        for child in elem:
+            self.write(child)
+
+        del elem[:]
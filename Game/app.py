@@ -119,7 +119,16 @@ class NeoITPyApp(ShowBase):
         self.gui.show_target_info(False)
         self.gui.switch_to_screen("HUD", FadeTransition())
         self.cam_mgr.change_mode(CAM_MODE_FREE)
-        self.world_mgr.load_map("./data/maps/Waterfall Cave")
+
+        #Show the loading info after starting the load, since cancelling the
+        #previous load hides it
+        self.world_mgr.load_map_async("./data/maps/Waterfall Cave", 
+            self.on_map_loaded, self.gui.set_loading_progress)
+        self.gui.show_loading_info(True)
+
+    def on_map_loaded(self, success):
+        """Called when a map has finished loading."""
+        self.gui.show_loading_info(False)
 
     def leave_campaign_select(self):
         """Leave the campaign select screen and return to the title screen."""
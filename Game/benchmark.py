@@ -0,0 +1,320 @@
+#!/usr/bin/python3
+"""New Impressive Title - Benchmarks"""
+
+import argparse
+import json
+import platform
+import sys
+import time
+
+from direct.showbase.ShowBase import ShowBase
+import numpy as np
+from panda3d.core import (
+    CollisionHandlerEvent,
+    CollisionTraverser,
+    load_prc_file_data,
+    ModelPool,
+    NodePath,
+    PandaSystem,
+    TexturePool,
+    Vec3
+    )
+
+from camera import FreeCam
+from collision import CollisionWorld, collision_cell_size
+from mapdata import (get_map_cache_file, parse_map_xml, read_map_cache,
+    write_map_cache)
+from utils import exhaust
+from world import MapCache, TextureCache, WorldManager
+
+
+#Constants
+#===============================================================================
+BENCH_MAP_SIZE = 10000 #size of the square area that benchmark data covers
+BENCH_FRAME_TIME = 1 / 60 #delta time of each simulated frame
+
+
+#Functions
+#===============================================================================
+def time_calls(func, args):
+    """Call a function once with each tuple of arguments and return the
+    average time per call in seconds.
+    """
+    start = time.perf_counter()
+
+    for arg in args:
+        func(*arg)
+
+    return (time.perf_counter() - start) / max(len(args), 1)
+
+
+def make_collision_world(count, rng):
+    """Make a collision world with the given number of random boxes and
+    spheres.
+    """
+    centers = rng.uniform(0, BENCH_MAP_SIZE, (count // 2, 3))
+    sizes = rng.uniform(10, 80, (count // 2, 3))
+    boxes = np.hstack([centers - sizes / 2, centers + sizes / 2])
+    spheres = np.hstack([
+        rng.uniform(0, BENCH_MAP_SIZE, (count - count // 2, 3)),
+        rng.uniform(5, 40, (count - count // 2, 1))
+        ])
+    return CollisionWorld(boxes, spheres)
+
+
+def bench_collision(args):
+    """Measure the cost of collision queries against the number of
+    colliders. Each world is queried through its grid and again with a single
+    cell that holds every collider, which is the cost of testing them all.
+    """
+    rng = np.random.default_rng(args.seed)
+    spheres = [(rng.uniform(0, BENCH_MAP_SIZE, 3), rng.uniform(1, 20))
+        for i in range(args.queries)]
+    rays = [(rng.uniform(0, BENCH_MAP_SIZE, 3), rng.normal(size = 3),
+        args.ray_length) for i in range(args.queries)]
+    cell_size = collision_cell_size.get_value()
+
+    print("{:>10} {:>10} {:>12} {:>12} {:>12} {:>12}".format("colliders",
+        "build ms", "sphere us", "ray us", "flat sph us", "flat ray us"))
+
+    for count in args.counts:
+        #Time the grid
+        collision_cell_size.set_value(cell_size)
+        start = time.perf_counter()
+        world = make_collision_world(count, np.random.default_rng(args.seed))
+        build_time = time.perf_counter() - start
+        sphere_time = time_calls(world.push_sphere, spheres)
+        ray_time = time_calls(world.cast_ray, rays)
+
+        #Time a single cell
+        collision_cell_size.set_value(BENCH_MAP_SIZE * 2)
+        world = make_collision_world(count, np.random.default_rng(args.seed))
+        flat_sphere_time = time_calls(world.push_sphere, spheres)
+        flat_ray_time = time_calls(world.cast_ray, rays)
+
+        print("{:>10} {:>10.2f} {:>12.1f} {:>12.1f} {:>12.1f} {:>12.1f}".format(
+            count, build_time * 1000, sphere_time * 1e6, ray_time * 1e6,
+            flat_sphere_time * 1e6, flat_ray_time * 1e6))
+
+    collision_cell_size.set_value(cell_size)
+
+
+def legacy_free_cam_update(camera_np, move_vec, rot_vec, dt):
+    """The free camera update that FreeCam replaced."""
+    camera_np.set_hpr(camera_np.get_hpr() + rot_vec * dt)
+    pos = camera_np.get_pos()
+    vec = Vec3(move_vec.x, move_vec.y, 0) * dt
+    camera_np.set_pos(pos + camera_np.get_quat(camera_np.get_parent()).xform(vec))
+    camera_np.set_z(camera_np.get_z() + move_vec.z * dt)
+
+
+def bench_camera(args):
+    """Measure the per-frame cost of the free camera update against the
+    update it replaced, and check that both move the camera the same way.
+    """
+    root = NodePath("render")
+    move_vec = Vec3(100, 500, 50)
+    rot_vec = Vec3(30, 10, 0)
+    free_cam = FreeCam(root.attach_new_node("camera"))
+    legacy_np = root.attach_new_node("legacy-camera")
+
+    #Check that both updates agree
+    for i in range(args.check_frames):
+        free_cam.update(move_vec, rot_vec, BENCH_FRAME_TIME)
+        legacy_free_cam_update(legacy_np, move_vec, rot_vec, BENCH_FRAME_TIME)
+
+    error = (free_cam.np.get_pos() - legacy_np.get_pos()).length()
+
+    #Time both updates
+    frames = [(move_vec, rot_vec, BENCH_FRAME_TIME)] * args.frames
+    free_cam_time = time_calls(free_cam.update, frames)
+    legacy_time = time_calls(
+        lambda *frame: legacy_free_cam_update(legacy_np, *frame), frames)
+
+    print("{:>12} {:>12}".format("update", "us/frame"))
+    print("{:>12} {:>12.2f}".format("legacy", legacy_time * 1e6))
+    print("{:>12} {:>12.2f}".format("free cam", free_cam_time * 1e6))
+    print("Position difference after {} frames: {:.6f}".format(
+        args.check_frames, error))
+
+
+def step_frames(count):
+    """Run the given number of frames and return the time each one took."""
+    frame_times = []
+
+    for i in range(count):
+        start = time.perf_counter()
+        base.task_mgr.step()
+        frame_times.append(time.perf_counter() - start)
+
+    return frame_times
+
+
+def bench_map(world_mgr, map, args):
+    """Load a map from scratch and return its timings."""
+    #Start from a cold cache
+    world_mgr.unload_map(True)
+    world_mgr.textures = TextureCache()
+    world_mgr.map_cache = MapCache()
+    ModelPool.release_all_models()
+    TexturePool.release_all_textures()
+
+    #Time parsing the map XML and reading the compiled map
+    map_file = world_mgr.get_map_file(map)
+
+    if map_file is None:
+        return {"map": map, "error": "Map file not found."}
+
+    start = time.perf_counter()
+    map_data = parse_map_xml(map_file)
+    parse_time = time.perf_counter() - start
+
+    if map_data is None:
+        return {"map": map, "error": "Failed to parse map file."}
+
+    cache_file = get_map_cache_file(map_file)
+    write_map_cache(cache_file, map_file, map_data)
+    start = time.perf_counter()
+    read_map_cache(cache_file, map_file)
+    cache_time = time.perf_counter() - start
+
+    #Time loading the models and textures
+    start = time.perf_counter()
+    meshes = set(map_data.get_meshes())
+
+    for mesh in meshes:
+        world_mgr.prototypes.acquire(mesh)
+        world_mgr.prototypes.release(mesh)
+
+    world_mgr.textures.preload(world_mgr.get_texture_manifest(map_data))
+    model_time = time.perf_counter() - start
+
+    #Time building the entities
+    start = time.perf_counter()
+    exhaust(world_mgr.build_map(map, map_data))
+    build_time = time.perf_counter() - start
+
+    #Run frames until the scenery around the camera has been combined
+    collect_count = world_mgr.collect_count
+    collect_time = world_mgr.collect_time
+    settle_frames = 0
+
+    while settle_frames < args.max_settle_frames:
+        step_frames(1)
+        settle_frames += 1
+
+        if len(world_mgr.dirty_cells) == 0 and world_mgr.load_task is None:
+            break
+
+    #Measure steady-state frames
+    frame_times = sorted(step_frames(args.frames))
+
+    return {
+        "map": map,
+        "objects": len(map_data.objects) + sum(
+            len(group.transforms) for group in map_data.groups),
+        "meshes": len(meshes),
+        "parse_time": parse_time,
+        "cache_read_time": cache_time,
+        "model_load_time": model_time,
+        "build_time": build_time,
+        "collect_count": world_mgr.collect_count - collect_count,
+        "collect_time": world_mgr.collect_time - collect_time,
+        "settle_frames": settle_frames,
+        "frame_time_mean": sum(frame_times) / max(len(frame_times), 1),
+        "frame_time_median": frame_times[len(frame_times) // 2] 
+            if len(frame_times) > 0 else 0,
+        "frame_time_p95": frame_times[int(len(frame_times) * .95)]
+            if len(frame_times) > 0 else 0,
+        "frame_time_max": frame_times[-1] if len(frame_times) > 0 else 0
+        }
+
+
+def bench_maps(args):
+    """Load each map in a headless app and record how long each stage of
+    loading took and the steady-state frame time. The results are written as
+    JSON.
+    """
+    #Setup a headless app
+    load_prc_file_data("", """
+window-type {}
+audio-library-name null
+sync-video false
+""".format(args.window_type))
+
+    ShowBase()
+
+    #ShowBase doesn't make a camera without a window, but the world manager
+    #streams the scenery around it
+    if base.camera is None:
+        base.camera = render.attach_new_node("camera")
+
+    base.cTrav = CollisionTraverser()
+    base.portal_handler = CollisionHandlerEvent()
+    base.portal_handler.add_in_pattern("%fn-entered-%in")
+    base.world_mgr = WorldManager()
+
+    #Benchmark each map
+    results = {
+        "time": time.time(),
+        "python": platform.python_version(),
+        "panda3d": PandaSystem.get_version_string(),
+        "window_type": args.window_type,
+        "frames": args.frames,
+        "maps": [bench_map(base.world_mgr, map, args) for map in args.maps]
+        }
+
+    #Write the results
+    if args.output is None:
+        json.dump(results, sys.stdout, indent = 4)
+        print()
+
+    else:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent = 4)
+
+        print("Results written to '{}'.".format(args.output))
+
+
+def main():
+    """Run the benchmark given on the command line."""
+    argparser = argparse.ArgumentParser(description = __doc__)
+    subparsers = argparser.add_subparsers(dest = "benchmark")
+    subparsers.required = True
+
+    #Collision benchmark
+    parser = subparsers.add_parser("collision",
+        help = "Query cost of the static collision world vs. collider count")
+    parser.add_argument("--counts", type = int, nargs = "+",
+        default = [100, 1000, 10000, 100000])
+    parser.add_argument("--queries", type = int, default = 1000)
+    parser.add_argument("--ray-length", type = float, default = 500)
+    parser.add_argument("--seed", type = int, default = 0)
+    parser.set_defaults(func = bench_collision)
+
+    #Camera benchmark
+    parser = subparsers.add_parser("camera",
+        help = "Per-frame cost of the free camera update")
+    parser.add_argument("--frames", type = int, default = 100000)
+    parser.add_argument("--check-frames", type = int, default = 600)
+    parser.set_defaults(func = bench_camera)
+
+    #Map loading benchmark
+    parser = subparsers.add_parser("maps",
+        help = "Load times and frame time of maps in a headless app")
+    parser.add_argument("maps", nargs = "+")
+    parser.add_argument("--window-type", choices = ["offscreen", "none"],
+        default = "offscreen")
+    parser.add_argument("--frames", type = int, default = 300)
+    parser.add_argument("--max-settle-frames", type = int, default = 600)
+    parser.add_argument("--output")
+    parser.set_defaults(func = bench_maps)
+
+    args = argparser.parse_args()
+    args.func(args)
+
+
+#Entry Point
+#===============================================================================
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,20 @@
 """New Impressive Title - Camera API"""
 
+import math
+
 from direct.task.Task import Task
 from kivy.logger import Logger
-from panda3d.core import ClockObject, CollisionNode, CollisionSphere, Vec3
+from panda3d.core import (
+    ClockObject,
+    CollisionNode,
+    CollisionSphere,
+    LMatrix3f,
+    look_at,
+    LQuaternionf,
+    Point3,
+    TransformState,
+    Vec3
+    )
 
 
 #Constants
@@ -11,9 +23,156 @@ CAM_MODE_FIRST_PERSON = 0
 CAM_MODE_CHASE = 1
 CAM_MODE_FREE = 2
 
+CAM_RADIUS = 10 #radius of the camera collider
+CAM_EYE_HEIGHT = 6 #height of the eyes of the target
+CAM_CHASE_DISTANCE = 60 #distance of the chase camera behind the target
+CAM_CHASE_HEIGHT = 20 #height of the chase camera above the target
+CAM_CHASE_SMOOTHING = 5 #rate at which the chase camera catches up
+CAM_TERRAIN_CLEARANCE = 2 #minimum height of the camera above the terrain
+CAM_MAX_PITCH = 80 #maximum pitch of the camera in degrees
+
 
 #Classes
 #==============================================================================
+class FreeCam(object):
+    """The movement of a free camera. The vectors used to move the camera are
+    allocated once and reused every frame, and the camera transform is only
+    written once per frame.
+    """
+    def __init__(self, np):
+        """Setup this free camera for the given node."""
+        self.np = np
+        self.pos = Point3(np.get_pos())
+        self.hpr = Vec3(np.get_hpr())
+        self.quat = LQuaternionf()
+        self.rot_mat = LMatrix3f()
+        self.step = Vec3(0, 0, 0)
+        self.transform = np.get_transform()
+
+    def update(self, move_vec, rot_vec, dt):
+        """Move the camera by the given movement and rotation vectors."""
+        #Nothing to do while the camera is idle
+        if (move_vec.x == 0 and move_vec.y == 0 and move_vec.z == 0 and
+            rot_vec.x == 0 and rot_vec.y == 0):
+            return
+
+        #Pick up any changes made to the camera elsewhere
+        transform = self.np.get_transform()
+
+        if transform != self.transform:
+            self.pos = Point3(transform.get_pos())
+            self.hpr = Vec3(transform.get_hpr())
+
+        #Update rotation first
+        self.hpr.add_x(rot_vec.x * dt)
+        self.hpr.add_y(rot_vec.y * dt)
+
+        #Now move along the heading and pitch of the camera, then rise or fall
+        self.step.set(move_vec.x * dt, move_vec.y * dt, 0)
+        self.quat.set_hpr(self.hpr)
+        self.quat.extract_to_matrix(self.rot_mat)
+        self.rot_mat.xform_in_place(self.step)
+        self.pos += self.step
+        self.pos.add_z(move_vec.z * dt)
+
+        #Write the new transform
+        self.transform = TransformState.make_pos_hpr(self.pos, self.hpr)
+        self.np.set_transform(self.transform)
+
+
+class FollowCam(object):
+    """The movement of a camera that follows a target node in first person or
+    chase mode. The chase camera eases toward its place behind the target
+    instead of snapping to it. In both modes the camera is kept above the
+    terrain with a heightfield lookup and the chase camera is pushed out of
+    the static collision world, so no collision traversal is needed.
+    """
+    def __init__(self, np):
+        """Setup this follow camera for the given node."""
+        self.np = np
+        self.pos = Point3(np.get_pos())
+        self.hpr = Vec3(0, 0, 0)
+        self.dir = Vec3(0, 0, 0)
+        self.up = Vec3(0, 0, 1)
+        self.quat = LQuaternionf()
+        self.pitch = 0
+        self.orbit = 0
+        self.snap = True
+
+    def reset(self):
+        """Snap the camera to its place on the next update."""
+        self.pitch = 0
+        self.orbit = 0
+        self.snap = True
+
+    def look(self, rot_vec, dt):
+        """Turn the camera by the given rotation vector. The heading orbits
+        the chase camera around the target and the pitch tilts the first
+        person camera.
+        """
+        self.orbit = (self.orbit + rot_vec.x * dt) % 360
+        self.pitch = min(max(self.pitch + rot_vec.y * dt, -CAM_MAX_PITCH),
+            CAM_MAX_PITCH)
+
+    def update(self, target, mode, dt):
+        """Move the camera to follow the given target."""
+        pos = target.get_pos(render)
+        h = target.get_h(render)
+        eye_z = pos.z + CAM_EYE_HEIGHT
+
+        #First person? The camera sits at the eyes of the target.
+        if mode == CAM_MODE_FIRST_PERSON:
+            self.pos.set(pos.x, pos.y, eye_z)
+
+        #Chase? The camera eases toward its place behind the target.
+        else:
+            heading = math.radians(h + self.orbit)
+            x = pos.x + math.sin(heading) * CAM_CHASE_DISTANCE
+            y = pos.y - math.cos(heading) * CAM_CHASE_DISTANCE
+            z = pos.z + CAM_CHASE_HEIGHT
+
+            if self.snap:
+                self.pos.set(x, y, z)
+
+            else:
+                blend = 1 - math.exp(-CAM_CHASE_SMOOTHING * dt)
+                self.pos.set(
+                    self.pos.x + (x - self.pos.x) * blend,
+                    self.pos.y + (y - self.pos.y) * blend,
+                    self.pos.z + (z - self.pos.z) * blend
+                    )
+
+            #Keep the camera out of static solids
+            collision = base.world_mgr.collision
+
+            if collision is not None:
+                self.pos.set(*collision.push_sphere(self.pos, 
+                    CAM_RADIUS).tolist())
+
+        self.snap = False
+
+        #Keep the camera above the terrain
+        ground_z = (base.world_mgr.get_terrain_height(self.pos) + 
+            CAM_TERRAIN_CLEARANCE)
+
+        if self.pos.z < ground_z:
+            self.pos.z = ground_z
+
+        #Look where the target looks or at the target
+        if mode == CAM_MODE_FIRST_PERSON:
+            self.hpr.set(h, self.pitch, 0)
+            self.quat.set_hpr(self.hpr)
+
+        else:
+            self.dir.set(pos.x - self.pos.x, pos.y - self.pos.y, 
+                eye_z - self.pos.z)
+            look_at(self.quat, self.dir, self.up)
+
+        #Write the new transform
+        self.np.set_transform(TransformState.make_pos_quat(self.pos, 
+            self.quat))
+
+
 class CameraManager(object):
     """A high-level camera manager. Manages camera mode and movement."""
     def __init__(self):
@@ -69,6 +228,9 @@ class CameraManager(object):
         base.cTrav.add_collider(self.collider, base.portal_handler)
 
         #Start camera manager task
+        self.clock = ClockObject.get_global_clock()
+        self.free_cam = FreeCam(base.camera)
+        self.follow_cam = FollowCam(base.camera)
         base.task_mgr.add(self.run_logic)
         Logger.info("Camera manager initialized.")
 
@@ -78,6 +240,7 @@ class CameraManager(object):
         self.speed = 500
         self.move_vec = Vec3(0, 0, 0)
         self.rot_vec = Vec3(0, 0, 0)
+        self.target = None
 
         base.disable_mouse()
         base.camera.set_pos(0, 0, 0)
@@ -86,6 +249,7 @@ class CameraManager(object):
     def change_mode(self, mode):
         """Change the current camera mode."""
         self.mode = mode
+        self.follow_cam.reset()
 
         if mode == CAM_MODE_FIRST_PERSON:
             Logger.info("Camera mode changed to first person cam.")
@@ -96,6 +260,11 @@ class CameraManager(object):
         elif mode == CAM_MODE_FREE:
             Logger.info("Camera mode changed to free cam.")
 
+    def set_target(self, target):
+        """Set the node that the first person and chase cameras follow."""
+        self.target = target
+        self.follow_cam.reset()
+
     def set_move_vec_x(self, x):
         """Set the X movement vector of the camera. This is only used in free
         mode.
@@ -115,8 +284,8 @@ class CameraManager(object):
         self.move_vec.z = z
 
     def set_rot_vec_h(self, h):
-        """Set the heading rotation vector of the camera. This is only used in
-        free mode.
+        """Set the heading rotation vector of the camera. In chase mode, this
+        orbits the camera around its target.
         """
         self.rot_vec.x = h
 
@@ -127,18 +296,17 @@ class CameraManager(object):
     def run_logic(self, task):
         """Run the logic for this camera manager."""
         #Get delta time
-        dt = ClockObject.get_global_clock().get_dt()
+        dt = self.clock.get_dt()
 
-        #We only need to execute logic for the free camera here
+        #Update the free camera
         if self.mode == CAM_MODE_FREE:
-            #Update rotation first
-            base.camera.set_hpr(base.camera.get_hpr() + self.rot_vec * dt)
-
-            #Now update position
-            pos = base.camera.get_pos()
-            vec = Vec3(self.move_vec.x, self.move_vec.y, 0) * dt
-            base.camera.set_pos(pos + base.camera.get_quat(render).xform(vec))
-            base.camera.set_z(base.camera.get_z() + self.move_vec.z * dt)
+            self.free_cam.update(self.move_vec, self.rot_vec, dt)
+
+        #Update the first person or chase camera. These need a target to
+        #follow.
+        elif self.target is not None:
+            self.follow_cam.look(self.rot_vec, dt)
+            self.follow_cam.update(self.target, self.mode, dt)
 
         #Continue this task infinitely
         return Task.cont
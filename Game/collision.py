@@ -0,0 +1,351 @@
+"""New Impressive Title - Collision API"""
+
+import math
+
+from kivy.logger import Logger
+import numpy as np
+from panda3d.core import ConfigVariableDouble
+
+
+#Constants
+#==============================================================================
+collision_cell_size = ConfigVariableDouble("collision-cell-size", 250,
+    "The size of each cell of the static collision grid.")
+
+
+#Classes
+#==============================================================================
+class CollisionWorld(object):
+    """A static collision world that is built once for each map. Solid boxes
+    and spheres are indexed by a uniform grid over the XY plane, so sphere and
+    ray queries only test the solids in the cells that they touch. Boxes are
+    stored as rows of min and max corners and spheres as rows of a center and
+    a radius. Inner boxes and spheres keep things inside of them instead of
+    out. There are only ever a few of them, so they are always tested.
+    """
+    def __init__(self, boxes, spheres, inner_boxes = (), inner_spheres = ()):
+        """Setup this collision world."""
+        self.boxes = np.asarray(boxes, np.float64).reshape(-1, 6)
+        self.spheres = np.asarray(spheres, np.float64).reshape(-1, 4)
+        self.inner_boxes = np.asarray(inner_boxes, np.float64).reshape(-1, 6)
+        self.inner_spheres = np.asarray(inner_spheres, np.float64).reshape(
+            -1, 4)
+        self.cell_size = collision_cell_size.get_value()
+
+        #Find the XY bounds of each solid
+        radii = self.spheres[:, 3]
+        bounds = np.concatenate([
+            self.boxes[:, [0, 1, 3, 4]],
+            np.column_stack([
+                self.spheres[:, 0] - radii,
+                self.spheres[:, 1] - radii,
+                self.spheres[:, 0] + radii,
+                self.spheres[:, 1] + radii
+                ])
+            ])
+
+        #Fit the grid to the solids
+        if len(bounds) > 0:
+            self.origin = bounds[:, :2].min(axis = 0)
+            extent = bounds[:, 2:].max(axis = 0) - self.origin
+
+        else:
+            self.origin = np.zeros(2)
+            extent = np.zeros(2)
+
+        self.grid_size = tuple(
+            max(1, int(math.ceil(size / self.cell_size))) for size in extent)
+
+        #Build a compressed list of the solids in each cell. The solids of
+        #cell i are cell_items[cell_starts[i]:cell_starts[i + 1]]. Boxes come
+        #first, followed by spheres.
+        cells = self.get_cell_ranges(bounds)
+        widths = cells[:, 2] - cells[:, 0] + 1
+        counts = widths * (cells[:, 3] - cells[:, 1] + 1)
+        item_ids = np.repeat(np.arange(len(cells)), counts)
+        offsets = np.arange(counts.sum()) - np.repeat(
+            np.cumsum(counts) - counts, counts)
+        xs = cells[item_ids, 0] + offsets % widths[item_ids]
+        ys = cells[item_ids, 1] + offsets // widths[item_ids]
+        cell_ids = ys * self.grid_size[0] + xs
+        order = np.argsort(cell_ids, kind = "stable")
+        self.cell_items = item_ids[order]
+        self.cell_starts = np.searchsorted(cell_ids[order],
+            np.arange(self.grid_size[0] * self.grid_size[1] + 1))
+
+        Logger.info("Collision world built: {} boxes, {} spheres, {}x{} cells".format(
+            len(self.boxes), len(self.spheres), *self.grid_size))
+
+    @classmethod
+    def from_map_data(cls, map_data):
+        """Build the collision world for the given map data."""
+        #Collision boxes are centered on their position
+        colboxes = np.asarray(map_data.colboxes, np.float64)
+        half_size = np.abs(colboxes[:, 3:]) / 2
+        boxes = [np.hstack([colboxes[:, :3] - half_size,
+            colboxes[:, :3] + half_size])]
+        spheres = [map_data.colspheres]
+
+        #Sphere walls either keep things in or out
+        sphere_walls = np.asarray(map_data.sphere_walls, np.float64)
+        inside = sphere_walls[:, 4] > .5
+        spheres.append(sphere_walls[~inside, :4])
+        inner_spheres = sphere_walls[inside, :4]
+
+        #Box walls extend infinitely along the Z axis
+        box_walls = np.asarray(map_data.box_walls, np.float64)
+        inside = box_walls[:, 7] > .5
+        wall_boxes = np.column_stack([
+            box_walls[:, 0] - box_walls[:, 3],
+            box_walls[:, 1] - box_walls[:, 5],
+            np.full(len(box_walls), -np.inf),
+            box_walls[:, 0] + box_walls[:, 4],
+            box_walls[:, 1] + box_walls[:, 6],
+            np.full(len(box_walls), np.inf)
+            ])
+        boxes.append(wall_boxes[~inside])
+        inner_boxes = wall_boxes[inside]
+
+        return cls(np.concatenate(boxes), np.concatenate(spheres),
+            inner_boxes, inner_spheres)
+
+    def get_cell_ranges(self, bounds):
+        """Get the ranges of cells covered by the given rows of XY bounds. Each
+        range is a row of min and max cell coordinates clamped to the grid.
+        """
+        bounds = np.asarray(bounds, np.float64).reshape(-1, 4)
+        cells = np.floor((bounds - np.tile(self.origin, 2)) / self.cell_size)
+        cells[:, [0, 2]] = np.clip(cells[:, [0, 2]], 0, self.grid_size[0] - 1)
+        cells[:, [1, 3]] = np.clip(cells[:, [1, 3]], 0, self.grid_size[1] - 1)
+        return cells.astype(int)
+
+    def get_items(self, cells):
+        """Get the solids in the given cells."""
+        items = [self.cell_items[self.cell_starts[cell]:
+            self.cell_starts[cell + 1]] for cell in cells]
+
+        if len(items) == 0:
+            return self.cell_items[:0]
+
+        return np.unique(np.concatenate(items))
+
+    def get_solids(self, items):
+        """Split the given solids into boxes and spheres."""
+        count = len(self.boxes)
+        return (self.boxes[items[items < count]],
+            self.spheres[items[items >= count] - count])
+
+    def get_sphere_solids(self, center, radius):
+        """Get the boxes and spheres in the cells touched by a sphere."""
+        x1, y1, x2, y2 = self.get_cell_ranges([center[0] - radius,
+            center[1] - radius, center[0] + radius, center[1] + radius])[0]
+        cells = [y * self.grid_size[0] + x
+            for y in range(y1, y2 + 1) for x in range(x1, x2 + 1)]
+        return self.get_solids(self.get_items(cells))
+
+    def get_ray_cells(self, origin, direction, max_dist):
+        """Get the cells that a ray passes through, in order."""
+        #Clip the ray to the grid
+        t_min = 0
+        t_max = max_dist
+        grid_min = self.origin
+        grid_max = self.origin + np.array(self.grid_size) * self.cell_size
+
+        for axis in range(2):
+            if direction[axis] == 0:
+                if not grid_min[axis] <= origin[axis] <= grid_max[axis]:
+                    return []
+
+                continue
+
+            t1 = (grid_min[axis] - origin[axis]) / direction[axis]
+            t2 = (grid_max[axis] - origin[axis]) / direction[axis]
+            t_min = max(t_min, min(t1, t2))
+            t_max = min(t_max, max(t1, t2))
+
+        if t_min > t_max:
+            return []
+
+        #Walk the cells along the clipped ray
+        start = (origin[:2] + direction[:2] * t_min - grid_min) / self.cell_size
+        cell = [min(max(int(start[axis]), 0), self.grid_size[axis] - 1)
+            for axis in range(2)]
+        step = [1 if direction[axis] > 0 else -1 for axis in range(2)]
+        t_next = []
+        t_delta = []
+
+        for axis in range(2):
+            if direction[axis] == 0:
+                t_next.append(math.inf)
+                t_delta.append(math.inf)
+                continue
+
+            edge = grid_min[axis] + (cell[axis] + (step[axis] > 0)) * self.cell_size
+            t_next.append((edge - origin[axis]) / direction[axis])
+            t_delta.append(self.cell_size / abs(direction[axis]))
+
+        cells = []
+
+        while (0 <= cell[0] < self.grid_size[0] and
+            0 <= cell[1] < self.grid_size[1]):
+            cells.append(cell[1] * self.grid_size[0] + cell[0])
+            axis = 0 if t_next[0] < t_next[1] else 1
+
+            if t_next[axis] > t_max:
+                break
+
+            cell[axis] += step[axis]
+            t_next[axis] += t_delta[axis]
+
+        return cells
+
+    def test_sphere(self, center, radius):
+        """Check if a sphere intersects any solid or leaves any inner box or
+        sphere.
+        """
+        center = np.asarray(center, np.float64)
+        boxes, spheres = self.get_sphere_solids(center, radius)
+
+        #Solid boxes
+        closest = np.clip(center, boxes[:, :3], boxes[:, 3:])
+
+        if (((center - closest) ** 2).sum(axis = 1) < radius ** 2).any():
+            return True
+
+        #Solid spheres
+        dist = np.sqrt(((center - spheres[:, :3]) ** 2).sum(axis = 1))
+
+        if (dist < radius + spheres[:, 3]).any():
+            return True
+
+        #Inner boxes
+        if ((center - radius < self.inner_boxes[:, :3]).any(axis = 1) |
+            (center + radius > self.inner_boxes[:, 3:]).any(axis = 1)).any():
+            return True
+
+        #Inner spheres
+        dist = np.sqrt(((center - self.inner_spheres[:, :3]) ** 2).sum(axis = 1))
+        return bool((dist + radius > self.inner_spheres[:, 3]).any())
+
+    def push_sphere(self, center, radius):
+        """Move a sphere out of every solid it intersects and back inside of
+        every inner box and sphere it leaves. Return the new center of the
+        sphere.
+        """
+        center = np.array(center, np.float64)
+        boxes, spheres = self.get_sphere_solids(center, radius)
+
+        #Push the sphere out of solid boxes
+        closest = np.clip(center, boxes[:, :3], boxes[:, 3:])
+        hits = ((center - closest) ** 2).sum(axis = 1) < radius ** 2
+
+        for box in boxes[hits]:
+            offset = center - np.clip(center, box[:3], box[3:])
+            dist = math.sqrt(offset.dot(offset))
+
+            #Push the sphere out along the shortest path if its center is
+            #inside the box
+            if dist == 0:
+                depths = np.concatenate([center - box[:3], box[3:] - center])
+                side = int(np.argmin(depths))
+                axis = side % 3
+                center[axis] += (depths[side] + radius) * (-1 if side < 3 else 1)
+
+            elif dist < radius:
+                center += offset * ((radius - dist) / dist)
+
+        #Push the sphere out of solid spheres
+        dist = np.sqrt(((center - spheres[:, :3]) ** 2).sum(axis = 1))
+        hits = dist < radius + spheres[:, 3]
+
+        for sphere in spheres[hits]:
+            offset = center - sphere[:3]
+            dist = math.sqrt(offset.dot(offset))
+
+            if dist == 0:
+                offset = np.array([0, 0, 1.])
+                dist = 1
+
+            if dist < radius + sphere[3]:
+                center += offset * ((radius + sphere[3] - dist) / dist)
+
+        #Keep the sphere inside of inner boxes
+        for box in self.inner_boxes:
+            center = np.clip(center, np.minimum(box[:3] + radius, box[3:]),
+                np.maximum(box[3:] - radius, box[:3]))
+
+        #Keep the sphere inside of inner spheres
+        for sphere in self.inner_spheres:
+            offset = center - sphere[:3]
+            dist = math.sqrt(offset.dot(offset))
+            limit = max(sphere[3] - radius, 0)
+
+            if dist > limit:
+                center = sphere[:3] + offset * (limit / dist)
+
+        return center
+
+    def cast_ray(self, origin, direction, max_dist):
+        """Cast a ray and return the distance to the first solid it hits or
+        the first inner box or sphere it leaves. If the ray doesn't hit
+        anything within the max distance, return None.
+        """
+        origin = np.asarray(origin, np.float64)
+        direction = np.asarray(direction, np.float64)
+        length = math.sqrt(direction.dot(direction))
+
+        if length == 0:
+            return None
+
+        direction = direction / length
+        boxes, spheres = self.get_solids(self.get_items(
+            self.get_ray_cells(origin, direction, max_dist)))
+        hits = [max_dist + 1]
+
+        #Solid boxes
+        near, far = self.get_slabs(origin, direction, boxes)
+        hit = (near <= far) & (far >= 0)
+        hits.extend(np.maximum(near[hit], 0).tolist())
+
+        #Solid spheres
+        near, far = self.get_sphere_spans(origin, direction, spheres)
+        hit = (near <= far) & (far >= 0)
+        hits.extend(np.maximum(near[hit], 0).tolist())
+
+        #Inner boxes the ray starts inside of
+        near, far = self.get_slabs(origin, direction, self.inner_boxes)
+        hits.extend(far[(near <= 0) & (far >= 0)].tolist())
+
+        #Inner spheres the ray starts inside of
+        near, far = self.get_sphere_spans(origin, direction,
+            self.inner_spheres)
+        hits.extend(far[(near <= 0) & (far >= 0)].tolist())
+
+        dist = min(hits)
+        return dist if dist <= max_dist else None
+
+    def get_slabs(self, origin, direction, boxes):
+        """Get the distances at which a ray enters and leaves each box."""
+        with np.errstate(divide = "ignore", invalid = "ignore"):
+            t1 = (boxes[:, :3] - origin) / direction
+            t2 = (boxes[:, 3:] - origin) / direction
+
+        #Rays parallel to a slab either always or never overlap it
+        parallel = direction == 0
+        inside = (origin >= boxes[:, :3]) & (origin <= boxes[:, 3:])
+        t1 = np.where(parallel, np.where(inside, -np.inf, np.inf), t1)
+        t2 = np.where(parallel, np.inf, t2)
+        near = np.minimum(t1, t2).max(axis = 1, initial = -np.inf)
+        far = np.maximum(t1, t2).min(axis = 1, initial = np.inf)
+        return near, far
+
+    def get_sphere_spans(self, origin, direction, spheres):
+        """Get the distances at which a ray enters and leaves each sphere."""
+        offset = origin - spheres[:, :3]
+        b = offset.dot(direction)
+        c = (offset ** 2).sum(axis = 1) - spheres[:, 3] ** 2
+        disc = b ** 2 - c
+        root = np.sqrt(np.maximum(disc, 0))
+        near = np.where(disc >= 0, -b - root, np.inf)
+        far = np.where(disc >= 0, -b + root, -np.inf)
+        return near, far
@@ -0,0 +1,47 @@
+#version 140
+
+//Hardware-instanced scenery fragment shader. Applies ambient light and up to
+//4 point or directional lights. Texels with an alpha below .5 are discarded
+//so that impostors and foliage cards are cut out.
+
+uniform sampler2D p3d_Texture0;
+
+uniform struct {
+    vec4 ambient;
+} p3d_LightModel;
+
+uniform struct {
+    vec4 color;
+    vec4 position;
+} p3d_LightSource[4];
+
+in vec2 texcoord;
+in vec3 view_pos;
+in vec3 normal;
+
+out vec4 p3d_FragColor;
+
+void main() {
+    vec4 color = texture(p3d_Texture0, texcoord);
+
+    if (color.a < 0.5) {
+        discard;
+    }
+
+    vec3 n = normalize(normal);
+    vec3 light = p3d_LightModel.ambient.rgb;
+
+    for (int i = 0; i < 4; i++) {
+        //Directional lights have a W of 0
+        vec3 dir = p3d_LightSource[i].position.xyz - 
+            view_pos * p3d_LightSource[i].position.w;
+
+        //Unused light slots have no position
+        if (dot(dir, dir) > 0.0) {
+            light += p3d_LightSource[i].color.rgb * 
+                max(dot(n, normalize(dir)), 0.0);
+        }
+    }
+
+    p3d_FragColor = vec4(color.rgb * light, color.a);
+}
@@ -0,0 +1,69 @@
+#version 140
+
+//Hardware-instanced scenery vertex shader. Each instance reads its transform
+//from 3 texels of the instance buffer. Each texel holds one column of the
+//instance's rotation/scale matrix followed by one coordinate of its position.
+//
+//The lod input holds the near and far distance of the level of detail being
+//drawn and whether it is a camera-facing impostor. Instances outside of that
+//range are moved outside of the view so they are clipped.
+
+uniform mat4 p3d_ModelViewProjectionMatrix;
+uniform mat4 p3d_ModelViewMatrix;
+uniform mat4 p3d_ProjectionMatrix;
+uniform mat3 p3d_NormalMatrix;
+uniform samplerBuffer instances;
+uniform vec3 lod;
+
+in vec4 p3d_Vertex;
+in vec3 p3d_Normal;
+in vec2 p3d_MultiTexCoord0;
+
+out vec2 texcoord;
+out vec3 view_pos;
+out vec3 normal;
+
+void main() {
+    //Fetch the transform of this instance
+    int index = gl_InstanceID * 3;
+    vec4 col0 = texelFetch(instances, index);
+    vec4 col1 = texelFetch(instances, index + 1);
+    vec4 col2 = texelFetch(instances, index + 2);
+    texcoord = p3d_MultiTexCoord0;
+
+    //Is this instance out of range for this level of detail?
+    vec4 origin = p3d_ModelViewMatrix * vec4(col0.w, col1.w, col2.w, 1.0);
+    float dist = length(origin.xyz);
+
+    if (dist < lod.x || dist >= lod.y) {
+        gl_Position = vec4(2.0, 2.0, 2.0, 1.0);
+        view_pos = vec3(0.0);
+        normal = vec3(0.0, 0.0, 1.0);
+        return;
+    }
+
+    //Impostors are expanded around the instance origin in view space so that
+    //they always face the camera
+    if (lod.z > 0.5) {
+        float scale = length(col0.xyz);
+        view_pos = origin.xyz + vec3(p3d_Vertex.x, p3d_Vertex.z, 0.0) * scale;
+        gl_Position = p3d_ProjectionMatrix * vec4(view_pos, 1.0);
+        normal = vec3(0.0, 0.0, 1.0);
+        return;
+    }
+
+    //Transform the vertex and normal
+    vec4 vertex = vec4(
+        dot(p3d_Vertex, col0),
+        dot(p3d_Vertex, col1),
+        dot(p3d_Vertex, col2),
+        1.0);
+    vec3 inst_normal = vec3(
+        dot(p3d_Normal, col0.xyz),
+        dot(p3d_Normal, col1.xyz),
+        dot(p3d_Normal, col2.xyz));
+
+    gl_Position = p3d_ModelViewProjectionMatrix * vertex;
+    view_pos = vec3(p3d_ModelViewMatrix * vertex);
+    normal = normalize(p3d_NormalMatrix * inst_normal);
+}
@@ -175,11 +175,21 @@ class HPBar(Widget):
     """An HP bar."""
     hp = NumericProperty(100)
     max_hp = NumericProperty(100)
+    textures = {}
 
     def __init__(self, **kwargs):
         """Setup this HP bar."""
         super(HPBar, self).__init__(**kwargs)
 
+        #Preload the bar textures. They are shared by every HP bar.
+        if len(HPBar.textures) == 0:
+            HPBar.textures["hp"] = CoreImage(
+                "./data/textures/GUI/hpbar.png").texture
+            HPBar.textures["wound"] = CoreImage(
+                "./data/textures/GUI/woundbar.png").texture
+
+        self.wounded = False
+
         with self.canvas:
             Color(1, 1, 1, .5)
             self.bg = Rectangle(pos = self.pos, size = self.size)
@@ -187,7 +197,7 @@ class HPBar(Widget):
             self.fg = Rectangle(
                 pos = self.pos, 
                 size = self.size, 
-                source = "./data/textures/GUI/hpbar.png"
+                texture = self.textures["hp"]
                 )
 
         self.bind(
@@ -206,11 +216,12 @@ class HPBar(Widget):
         ratio = self.hp / self.max_hp
         self.fg.size = (self.width * abs(ratio), self.height)
 
-        if ratio < 0:
-            self.fg.source = "./data/textures/GUI/woundbar.png"
+        #Only swap the bar texture when the HP changes sign
+        wounded = ratio < 0
 
-        else:
-            self.fg.source = "./data/textures/GUI/hpbar.png"
+        if wounded != self.wounded:
+            self.wounded = wounded
+            self.fg.texture = self.textures["wound" if wounded else "hp"]
 
 
 class MainScreen(ScreenManager):
@@ -287,6 +298,21 @@ class GUI(App):
             self.root.target_info.transition = SlideTransition(direction = "up")
             self.root.target_info.current = "Hide"
 
+    def show_loading_info(self, show):
+        """Show or hide the loading bar."""
+        self.root.loading_info.transition = NoTransition()
+
+        if show:
+            self.root.loading_bar.value = 0
+            self.root.loading_info.current = "Show"
+
+        else:
+            self.root.loading_info.current = "Hide"
+
+    def set_loading_progress(self, fraction):
+        """Set the fraction of the loading bar that is filled."""
+        self.root.loading_bar.value = fraction
+
 
 #Register custom widget classes
 #===============================================================================
@@ -0,0 +1,789 @@
+"""New Impressive Title - Map Data API"""
+
+import hashlib
+import math
+import mmap
+import os
+import struct
+import threading
+import xml.etree.ElementTree as etree
+import zlib
+
+import numpy as np
+from kivy.logger import Logger
+
+from utils import exhaust, parse_float, parse_vec, parse_vec_array
+
+
+#Constants
+#==============================================================================
+MAP_CACHE_MAGIC = b"NITM"
+MAP_CACHE_VERSION = 3
+MAP_CACHE_EXT = ".mapcache"
+MAP_CACHE_HEADER = struct.Struct("<4sIqQ20s") #magic, version, mtime, size, sha1
+MAP_CACHE_MTIME_OFFSET = 8 #offset of the mtime in the header
+
+PORTAL_STRIDE = 4 #x, y, z, radius
+GATE_STRIDE = 6 #x, y, z, dest x, dest y, dest z
+OBJECT_STRIDE = 9 #x, y, z, h, p, r, scale x, scale y, scale z
+COLBOX_STRIDE = 6 #x, y, z, size x, size y, size z
+COLSPHERE_STRIDE = 4 #x, y, z, radius
+SPHERE_WALL_STRIDE = 5 #x, y, z, radius, is inside
+BOX_WALL_STRIDE = 8 #x, y, z, -x range, +x range, -y range, +y range, is inside
+INSTANCE_DTYPE = np.dtype("<f4") #type of the values in instance files
+
+TERRAIN_BLOCK_SIZE = 64
+TERRAIN_LOD_NEAR = 500
+TERRAIN_LOD_FAR = 2000
+
+
+#Functions
+#==============================================================================
+def fit_vec(vec, size):
+    """Pad a vector with 0s or truncate it so that it has the given size."""
+    vec = list(vec[:size])
+    return vec + [0] * (size - len(vec))
+
+
+def pack_transform(pos, rot, scale):
+    """Pack a position, rotation, and scale into a single row of floats. A 2
+    coordinate position is given a NaN height, which means that the object
+    should be placed on the terrain.
+    """
+    #Handle 2 coordinate position
+    if len(pos) == 2:
+        pos = [pos[0], pos[1], math.nan]
+
+    #Handle single coordinate rotation
+    if len(rot) == 1:
+        rot = [rot[0], 0, 0]
+
+    #Handle single or double coordinate scale
+    if len(scale) == 1:
+        scale = [scale[0], scale[0], scale[0]]
+
+    elif len(scale) == 2:
+        scale = [scale[0], scale[1], 1]
+
+    return fit_vec(pos, 3) + fit_vec(rot, 3) + fit_vec(scale, 3)
+
+
+def pack_transforms(pos, rot, scale):
+    """Pack arrays of positions, rotations, and scales into rows of floats.
+    Each array has 3 columns and is padded with NaN where a vector has fewer
+    coordinates. Missing coordinates are handled the same way as
+    pack_transform.
+    """
+    #Missing rotation coordinates are 0
+    rot = np.where(np.isnan(rot), 0, rot)
+
+    #Single coordinate scales are uniform and double coordinate scales have
+    #a Z scale of 1
+    scale = np.array(scale)
+    single = np.isnan(scale[:, 1])
+    scale[single, 1:] = scale[single, :1]
+    scale[np.isnan(scale[:, 2]), 2] = 1
+
+    return np.hstack([pos, rot, scale]).astype(np.float32)
+
+
+def parse_wall_range(s):
+    """Parse the range of a box wall. The range lists the distances from the
+    position of the wall to its -X, +X, -Y, and +Y sides. A single distance is
+    used for every side, and 2 or 3 distances are used for the X and Y sides.
+    """
+    values = parse_vec(s, 1)
+
+    if len(values) == 1:
+        return values * 4
+
+    elif len(values) < 4:
+        return [values[0], values[0], values[1], values[1]]
+
+    return values[:4]
+
+
+def read_instances(instance_file, offset, count, crc = None):
+    """Read the instances of an object group from a binary instance file and
+    return them as rows of packed transforms. The instances are stored as 3
+    columns of count vectors each: positions, rotations, and scales. Upon
+    failure, return None.
+    """
+    size = count * OBJECT_STRIDE * INSTANCE_DTYPE.itemsize
+
+    try:
+        with open(instance_file, "rb") as f:
+            f.seek(offset)
+            data = f.read(size)
+
+    except OSError:
+        return None
+
+    #Validate the instances
+    if len(data) != size or (crc is not None and zlib.crc32(data) != crc):
+        return None
+
+    columns = np.frombuffer(data, INSTANCE_DTYPE).reshape(3, count, 3)
+    return np.hstack(columns).astype(np.float32)
+
+
+def parse_map_xml(map_file):
+    """Parse a map XML file and return its map data. Upon failure, return
+    None.
+    """
+    map_data = MapData()
+
+    if not exhaust(stream_map_xml(map_file, map_data)):
+        return None
+
+    map_data.pack()
+    return map_data
+
+
+def stream_map_xml(map_file, map_data):
+    """Parse a map XML file into the given map data one element at a time.
+    This is a generator that yields the kind of each entity, its index in the
+    map data, and the fraction of the file that has been parsed as soon as
+    the element for the entity closes. Parsed elements are cleared right away,
+    so only the element being parsed is ever kept in memory. It returns False
+    if the map is invalid and True otherwise.
+    """
+    file_size = max(os.path.getsize(map_file), 1)
+    stack = []
+    columns = ([], [], [])
+
+    with open(map_file, "rb") as f:
+        try:
+            for event, elem in etree.iterparse(f, ("start", "end")):
+                #Element opened?
+                if event == "start":
+                    #Object group? The attributes of its objects are
+                    #collected as they close and parsed all at once.
+                    if len(stack) == 1 and elem.tag == "objectgroup":
+                        columns = ([], [], [])
+
+                    stack.append(elem)
+                    continue
+
+                stack.pop()
+
+                #Group object closed?
+                if len(stack) == 2 and stack[1].tag == "objectgroup":
+                    #Validate object
+                    if not ("pos" in elem.attrib):
+                        Logger.warning("Group object must define 'pos'.")
+
+                    #Collect object attributes
+                    else:
+                        columns[0].append(elem.attrib["pos"])
+                        columns[1].append(elem.attrib.get("rot", "0"))
+                        columns[2].append(elem.attrib.get("scale", "1"))
+
+                    #Drop the object but keep the attributes of the group
+                    del stack[1][:]
+                    continue
+
+                #Only top-level elements define entities
+                if len(stack) != 1:
+                    continue
+
+                #Drop the element once it has been parsed
+                del stack[0][:]
+                fraction = min(f.tell() / file_size, 1)
+
+                #Terrain?
+                if elem.tag == "terrain":
+                    #Validate terrain
+                    if not ("size" in elem.attrib and "spawnpos" in elem.attrib
+                        and "heightmap" in elem.attrib):
+                        Logger.error("Terrain section must define 'size', 'spawnpos', and 'heightmap'.")
+                        return False
+
+                    #Parse terrain
+                    terrain = map_data.set_terrain(
+                        parse_vec(elem.attrib["size"], 3),
+                        parse_vec(elem.attrib["spawnpos"], 2),
+                        elem.attrib["heightmap"],
+                        elem.attrib.get("material", "")
+                        )
+
+                    #Parse optional level of detail settings
+                    terrain.lod = elem.attrib.get("lod", "false") == "true"
+
+                    if "lodnear" in elem.attrib:
+                        terrain.lod_near = parse_float(elem.attrib["lodnear"])
+
+                    if "lodfar" in elem.attrib:
+                        terrain.lod_far = parse_float(elem.attrib["lodfar"])
+
+                    if "blocksize" in elem.attrib:
+                        terrain.block_size = int(parse_float(
+                            elem.attrib["blocksize"])) or TERRAIN_BLOCK_SIZE
+
+                    yield ("terrain", 0, fraction)
+
+                #Portal?
+                elif elem.tag == "portal":
+                    #Validate portal
+                    if not ("pos" in elem.attrib and "destmap" in elem.attrib):
+                        Logger.warning("Portal must define 'pos' and 'destmap'.")
+                        continue
+
+                    #Parse portal
+                    pos = parse_vec(elem.attrib["pos"], 3)
+                    radius = parse_float(elem.attrib["radius"]) if "radius" in elem.attrib else 1
+                    destmap = elem.attrib["destmap"]
+                    map_data.add_portal(pos, radius, destmap)
+                    yield ("portal", len(map_data.portals) - 1, fraction)
+
+                #Gate?
+                elif elem.tag == "gate":
+                    #Validate gate
+                    if not ("pos" in elem.attrib and "destmap" in elem.attrib and
+                        "destvec" in elem.attrib):
+                        Logger.warning("Gate must define 'pos', 'destmap', and 'destvec'.")
+                        continue
+
+                    #Parse gate
+                    pos = parse_vec(elem.attrib["pos"], 3)
+                    destmap = elem.attrib["destmap"]
+                    destvec = parse_vec(elem.attrib["destvec"], 3)
+                    material = elem.attrib["material"] if "material" in elem.attrib else ""
+                    map_data.add_gate(pos, destmap, destvec, material)
+                    yield ("gate", len(map_data.gates) - 1, fraction)
+
+                #Object?
+                elif elem.tag == "object":
+                    #Validate object
+                    if not ("mesh" in elem.attrib and "pos" in elem.attrib):
+                        Logger.warning("Object must define 'mesh' and 'pos'.")
+                        continue
+
+                    #Parse object
+                    mesh = elem.attrib["mesh"]
+                    pos = parse_vec(elem.attrib["pos"], 3)
+                    rot = parse_vec(elem.attrib["rot"], 3) if "rot" in elem.attrib else [0, 0, 0]
+                    scale = parse_vec(elem.attrib["scale"], 3) if "scale" in elem.attrib else [1, 1, 1]
+                    material = elem.attrib["material"] if "material" in elem.attrib else ""
+                    sound = elem.attrib["sound"] if "sound" in elem.attrib else ""
+                    map_data.add_object(mesh, pos, rot, scale, material, sound)
+                    yield ("object", len(map_data.objects) - 1, fraction)
+
+                #Collision Box?
+                elif elem.tag == "colbox":
+                    #Validate collision box
+                    if not ("pos" in elem.attrib and "size" in elem.attrib):
+                        Logger.warning("Collision box must define 'pos' and 'size'.")
+                        continue
+
+                    #Parse collision box
+                    pos = parse_vec(elem.attrib["pos"], 3)
+                    size = parse_vec(elem.attrib["size"], 3)
+                    map_data.add_colbox(pos, size)
+                    yield ("colbox", len(map_data.colboxes) - 1, fraction)
+
+                #Collision Sphere?
+                elif elem.tag == "colsphere":
+                    #Validate collision sphere
+                    if not ("pos" in elem.attrib and "radius" in elem.attrib):
+                        Logger.warning("Collision sphere must define 'pos' and 'radius'.")
+                        continue
+
+                    #Parse collision sphere
+                    pos = parse_vec(elem.attrib["pos"], 3)
+                    radius = parse_float(elem.attrib["radius"])
+                    map_data.add_colsphere(pos, radius)
+                    yield ("colsphere", len(map_data.colspheres) - 1, fraction)
+
+                #Sphere Wall?
+                elif elem.tag == "spherewall":
+                    #Validate sphere wall
+                    if not ("pos" in elem.attrib and "radius" in elem.attrib):
+                        Logger.warning("Sphere wall must define 'pos' and 'radius'.")
+                        continue
+
+                    #Parse sphere wall
+                    pos = parse_vec(elem.attrib["pos"], 3)
+                    radius = parse_float(elem.attrib["radius"])
+                    is_inside = elem.attrib.get("isinside", "false") == "true"
+                    map_data.add_sphere_wall(pos, radius, is_inside)
+                    yield ("spherewall", len(map_data.sphere_walls) - 1, 
+                        fraction)
+
+                #Box Wall?
+                elif elem.tag == "boxwall":
+                    #Validate box wall
+                    if not ("pos" in elem.attrib and "range" in elem.attrib):
+                        Logger.warning("Box wall must define 'pos' and 'range'.")
+                        continue
+
+                    #Parse box wall
+                    pos = parse_vec(elem.attrib["pos"], 3)
+                    range = parse_wall_range(elem.attrib["range"])
+                    is_inside = elem.attrib.get("isinside", "false") == "true"
+                    map_data.add_box_wall(pos, range, is_inside)
+                    yield ("boxwall", len(map_data.box_walls) - 1, fraction)
+
+                #Object Group?
+                elif elem.tag == "objectgroup":
+                    #Validate object group
+                    if not ("mesh" in elem.attrib):
+                        Logger.warning("Object group must define 'mesh'.")
+                        continue
+
+                    #Parse the objects of the group
+                    mesh = elem.attrib["mesh"]
+                    material = elem.attrib["material"] if "material" in elem.attrib else ""
+                    transforms = pack_transforms(
+                        parse_vec_array(columns[0], 2, 3),
+                        parse_vec_array(columns[1], 1, 3),
+                        parse_vec_array(columns[2], 1, 3)
+                        )
+
+                    #Read the objects stored in an instance file
+                    if "instances" in elem.attrib:
+                        instances = read_instances(
+                            os.path.join(os.path.dirname(map_file),
+                            elem.attrib["instances"]),
+                            int(parse_float(elem.attrib.get("offset", "0"))),
+                            int(parse_float(elem.attrib.get("count", "0"))),
+                            int(parse_float(elem.attrib["crc"]))
+                            if "crc" in elem.attrib else None
+                            )
+
+                        if instances is None:
+                            Logger.warning(
+                                "Failed to read instances of object group '{}' from '{}'.".format(
+                                mesh, elem.attrib["instances"]))
+
+                        else:
+                            transforms = np.vstack([instances, transforms])
+
+                    map_data.add_object_group(mesh, material, transforms)
+                    columns = ([], [], [])
+                    yield ("objectgroup", len(map_data.groups) - 1, fraction)
+
+                #Unknown?
+                else:
+                    Logger.warning(
+                        "Unknown tag '{}' encountered in map '{}'.".format(
+                            elem.tag, map_file))
+
+        except etree.ParseError as e:
+            Logger.error("Failed to parse map file '{}': {}".format(
+                map_file, e))
+            return False
+
+    return True
+
+
+def hash_file(filename):
+    """Return the SHA-1 digest of the given file."""
+    sha1 = hashlib.sha1()
+
+    with open(filename, "rb") as f:
+        for block in iter(lambda: f.read(65536), b""):
+            sha1.update(block)
+
+    return sha1.digest()
+
+
+def get_map_cache_file(map_file):
+    """Return the path of the compiled map cache for the given map file."""
+    return os.path.splitext(map_file)[0] + MAP_CACHE_EXT
+
+
+def read_map_cache(cache_file, map_file):
+    """Read a compiled map cache file. If the cache is missing, corrupt, or
+    out of date with respect to the given map file, return None.
+    """
+    try:
+        with open(cache_file, "rb") as f:
+            buf = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+
+        #Validate the header
+        magic, version, mtime, size, digest = MAP_CACHE_HEADER.unpack_from(
+            buf, 0)
+
+        if magic != MAP_CACHE_MAGIC or version != MAP_CACHE_VERSION:
+            return None
+
+        #Is the cache stale? If only the timestamp changed, we can fall back
+        #to the content hash.
+        stat = os.stat(map_file)
+
+        if stat.st_size != size:
+            return None
+
+        if (stat.st_mtime_ns != mtime and
+            hash_file(map_file) != digest):
+            return None
+
+        #Read the map data
+        map_data = MapData.read(_CacheReader(buf, MAP_CACHE_HEADER.size))
+
+    except (OSError, ValueError, IndexError, struct.error,
+        UnicodeDecodeError):
+        return None
+
+    #Store the new timestamp so that later loads don't hash the map again
+    if stat.st_mtime_ns != mtime:
+        try:
+            with open(cache_file, "r+b") as f:
+                f.seek(MAP_CACHE_MTIME_OFFSET)
+                f.write(struct.pack("<q", stat.st_mtime_ns))
+
+        except OSError as e:
+            Logger.warning("Failed to update map cache '{}': {}".format(
+                cache_file, e))
+
+    return map_data
+
+
+def write_map_cache(cache_file, map_file, map_data):
+    """Write a compiled map cache file for the given map data."""
+    stat = os.stat(map_file)
+    tmp_file = "{}.{}.tmp".format(cache_file, threading.get_ident())
+
+    try:
+        with open(tmp_file, "wb") as f:
+            f.write(MAP_CACHE_HEADER.pack(MAP_CACHE_MAGIC, MAP_CACHE_VERSION,
+                stat.st_mtime_ns, stat.st_size, hash_file(map_file)))
+            map_data.write(_CacheWriter(f))
+
+        os.replace(tmp_file, cache_file)
+        return True
+
+    except OSError as e:
+        Logger.warning("Failed to write map cache '{}': {}".format(
+            cache_file, e))
+        return False
+
+
+def load_map_data(map_file):
+    """Load the data for the given map file. The compiled map cache is used if
+    it is up to date. Otherwise the map XML is parsed and the cache is
+    rebuilt. Upon failure, return None.
+    """
+    #Try the compiled map cache first
+    cache_file = get_map_cache_file(map_file)
+    map_data = read_map_cache(cache_file, map_file)
+
+    if map_data is not None:
+        Logger.info("Loaded compiled map '{}'.".format(cache_file))
+        return map_data
+
+    #Parse the map XML and compile it
+    map_data = parse_map_xml(map_file)
+
+    if map_data is not None:
+        write_map_cache(cache_file, map_file, map_data)
+
+    return map_data
+
+
+#Classes
+#==============================================================================
+class _CacheWriter(object):
+    """Writes 4-byte aligned values to a compiled map cache file."""
+    def __init__(self, f):
+        """Setup this cache writer."""
+        self.f = f
+
+    def write_u32(self, value):
+        """Write an unsigned 32-bit integer."""
+        self.f.write(struct.pack("<I", value))
+
+    def write_str(self, s):
+        """Write a string padded to a multiple of 4 bytes."""
+        data = s.encode("utf-8")
+        self.write_u32(len(data))
+        self.f.write(data + b"\0" * (-len(data) % 4))
+
+    def write_array(self, array, dtype):
+        """Write an array of 4 or 8-byte values."""
+        array = np.ascontiguousarray(array, dtype)
+        self.write_u32(array.size)
+        self.f.write(array.tobytes())
+
+
+class _CacheReader(object):
+    """Reads 4-byte aligned values from a memory-mapped compiled map cache."""
+    def __init__(self, buf, offset):
+        """Setup this cache reader."""
+        self.buf = buf
+        self.offset = offset
+
+    def read_u32(self):
+        """Read an unsigned 32-bit integer."""
+        value = struct.unpack_from("<I", self.buf, self.offset)[0]
+        self.offset += 4
+        return value
+
+    def read_str(self):
+        """Read a padded string."""
+        size = self.read_u32()
+        end = self.offset + size
+
+        if end > len(self.buf):
+            raise ValueError("String extends past the end of the cache.")
+
+        s = self.buf[self.offset:end].decode("utf-8")
+        self.offset = end + (-size % 4)
+        return s
+
+    def read_array(self, dtype, stride = 1):
+        """Read an array of 4 or 8-byte values without copying it."""
+        count = self.read_u32()
+        array = np.frombuffer(self.buf, dtype, count, self.offset)
+        self.offset += array.nbytes
+        return array.reshape(-1, stride) if stride > 1 else array
+
+
+class TerrainData(object):
+    """The terrain data for a map. If lod is True, the terrain is rendered at
+    full detail within lod_near of the camera and at the lowest detail past
+    lod_far. Otherwise it is always rendered at full detail.
+    """
+    def __init__(self, size, spawnpos, heightmap, material):
+        """Setup this terrain data."""
+        self.size = fit_vec(size, 3)
+        self.spawnpos = fit_vec(spawnpos, 2)
+        self.heightmap = heightmap
+        self.material = material
+        self.lod = False
+        self.lod_near = TERRAIN_LOD_NEAR
+        self.lod_far = TERRAIN_LOD_FAR
+        self.block_size = TERRAIN_BLOCK_SIZE
+
+
+class ObjectGroupData(object):
+    """The data for a group of objects that share a mesh."""
+    def __init__(self, mesh, material, transforms):
+        """Setup this object group data."""
+        self.mesh = mesh
+        self.material = material
+        self.transforms = transforms
+
+
+class MapData(object):
+    """The entities of a map stored as packed arrays. Strings are stored in a
+    shared string table and referenced by index.
+    """
+    def __init__(self):
+        """Setup this map data."""
+        self.strings = []
+        self.string_ids = {}
+        self.terrain = None
+        self.portals = []
+        self.portal_dests = []
+        self.gates = []
+        self.gate_dests = []
+        self.gate_materials = []
+        self.objects = []
+        self.object_meshes = []
+        self.object_materials = []
+        self.object_sounds = []
+        self.groups = []
+        self.colboxes = []
+        self.colspheres = []
+        self.sphere_walls = []
+        self.box_walls = []
+
+    def intern(self, s):
+        """Add a string to the string table and return its index."""
+        if s not in self.string_ids:
+            self.string_ids[s] = len(self.strings)
+            self.strings.append(s)
+
+        return self.string_ids[s]
+
+    def set_terrain(self, size, spawnpos, heightmap, material):
+        """Set the terrain of this map and return it."""
+        self.terrain = TerrainData(size, spawnpos, heightmap, material)
+        return self.terrain
+
+    def add_portal(self, pos, radius, dest):
+        """Add a portal to this map."""
+        self.portals.append(fit_vec(pos, 3) + [radius])
+        self.portal_dests.append(self.intern(dest))
+
+    def add_gate(self, pos, dest, destvec, material):
+        """Add a gate to this map."""
+        self.gates.append(fit_vec(pos, 3) + fit_vec(destvec, 3))
+        self.gate_dests.append(self.intern(dest))
+        self.gate_materials.append(self.intern(material))
+
+    def add_object(self, mesh, pos, rot, scale, material, sound):
+        """Add an object to this map."""
+        self.objects.append(pack_transform(pos, rot, scale))
+        self.object_meshes.append(self.intern(mesh))
+        self.object_materials.append(self.intern(material))
+        self.object_sounds.append(self.intern(sound))
+
+    def add_object_group(self, mesh, material, transforms):
+        """Add a group of objects to this map. Each transform is a row of
+        packed transform floats.
+        """
+        self.groups.append(ObjectGroupData(mesh, material,
+            np.asarray(transforms, np.float32).reshape(-1, OBJECT_STRIDE)))
+
+    def add_colbox(self, pos, size):
+        """Add a collision box to this map."""
+        self.colboxes.append(fit_vec(pos, 3) + fit_vec(size, 3))
+
+    def add_colsphere(self, pos, radius):
+        """Add a collision sphere to this map."""
+        self.colspheres.append(fit_vec(pos, 3) + [radius])
+
+    def add_sphere_wall(self, pos, radius, is_inside):
+        """Add a sphere wall to this map. If is_inside is True, the wall keeps
+        things inside of it. Otherwise it keeps things out.
+        """
+        self.sphere_walls.append(fit_vec(pos, 3) + [radius, is_inside])
+
+    def add_box_wall(self, pos, range, is_inside):
+        """Add a box wall to this map. If is_inside is True, the wall keeps
+        things inside of it. Otherwise it keeps things out.
+        """
+        self.box_walls.append(fit_vec(pos, 3) + fit_vec(range, 4) + 
+            [is_inside])
+
+    def pack(self):
+        """Convert the entity lists of this map into packed arrays."""
+        self.portals = np.asarray(self.portals, np.float32).reshape(
+            -1, PORTAL_STRIDE)
+        self.portal_dests = np.asarray(self.portal_dests, np.uint32)
+        self.gates = np.asarray(self.gates, np.float32).reshape(
+            -1, GATE_STRIDE)
+        self.gate_dests = np.asarray(self.gate_dests, np.uint32)
+        self.gate_materials = np.asarray(self.gate_materials, np.uint32)
+        self.objects = np.asarray(self.objects, np.float32).reshape(
+            -1, OBJECT_STRIDE)
+        self.object_meshes = np.asarray(self.object_meshes, np.uint32)
+        self.object_materials = np.asarray(self.object_materials, np.uint32)
+        self.object_sounds = np.asarray(self.object_sounds, np.uint32)
+        self.colboxes = np.asarray(self.colboxes, np.float32).reshape(
+            -1, COLBOX_STRIDE)
+        self.colspheres = np.asarray(self.colspheres, np.float32).reshape(
+            -1, COLSPHERE_STRIDE)
+        self.sphere_walls = np.asarray(self.sphere_walls, np.float32).reshape(
+            -1, SPHERE_WALL_STRIDE)
+        self.box_walls = np.asarray(self.box_walls, np.float32).reshape(
+            -1, BOX_WALL_STRIDE)
+
+    def get_meshes(self):
+        """Get the names of the meshes used by the objects of this map."""
+        meshes = [self.strings[mesh] 
+            for mesh in set(self.object_meshes.tolist())]
+        return meshes + [group.mesh for group in self.groups]
+
+    def estimate_memory(self):
+        """Estimate the number of bytes used by this map data."""
+        arrays = [self.portals, self.portal_dests, self.gates, self.gate_dests,
+            self.gate_materials, self.objects, self.object_meshes,
+            self.object_materials, self.object_sounds]
+        arrays += [self.colboxes, self.colspheres, self.sphere_walls, 
+            self.box_walls]
+        arrays += [group.transforms for group in self.groups]
+        return (sum(array.nbytes for array in arrays) + 
+            sum(len(s) for s in self.strings))
+
+    def write(self, writer):
+        """Write this map data with the given cache writer."""
+        #String table
+        writer.write_u32(len(self.strings))
+
+        for s in self.strings:
+            writer.write_str(s)
+
+        #Terrain
+        writer.write_u32(self.terrain is not None)
+
+        if self.terrain is not None:
+            writer.write_array(self.terrain.size + self.terrain.spawnpos + [
+                self.terrain.lod, self.terrain.lod_near, self.terrain.lod_far,
+                self.terrain.block_size], np.float64)
+            writer.write_str(self.terrain.heightmap)
+            writer.write_str(self.terrain.material)
+
+        #Portals
+        writer.write_array(self.portals, np.float32)
+        writer.write_array(self.portal_dests, np.uint32)
+
+        #Gates
+        writer.write_array(self.gates, np.float32)
+        writer.write_array(self.gate_dests, np.uint32)
+        writer.write_array(self.gate_materials, np.uint32)
+
+        #Objects
+        writer.write_array(self.objects, np.float32)
+        writer.write_array(self.object_meshes, np.uint32)
+        writer.write_array(self.object_materials, np.uint32)
+        writer.write_array(self.object_sounds, np.uint32)
+
+        #Collision volumes
+        writer.write_array(self.colboxes, np.float32)
+        writer.write_array(self.colspheres, np.float32)
+        writer.write_array(self.sphere_walls, np.float32)
+        writer.write_array(self.box_walls, np.float32)
+
+        #Object groups
+        writer.write_u32(len(self.groups))
+
+        for group in self.groups:
+            writer.write_str(group.mesh)
+            writer.write_str(group.material)
+            writer.write_array(group.transforms, np.float32)
+
+    @classmethod
+    def read(cls, reader):
+        """Read map data with the given cache reader."""
+        map_data = cls()
+
+        #String table
+        for i in range(reader.read_u32()):
+            map_data.intern(reader.read_str())
+
+        #Terrain
+        if reader.read_u32():
+            values = reader.read_array(np.float64).tolist()
+            heightmap = reader.read_str()
+            material = reader.read_str()
+            terrain = map_data.set_terrain(values[:3], values[3:5], heightmap,
+                material)
+            terrain.lod = bool(values[5])
+            terrain.lod_near = values[6]
+            terrain.lod_far = values[7]
+            terrain.block_size = int(values[8])
+
+        #Portals
+        map_data.portals = reader.read_array(np.float32, PORTAL_STRIDE)
+        map_data.portal_dests = reader.read_array(np.uint32)
+
+        #Gates
+        map_data.gates = reader.read_array(np.float32, GATE_STRIDE)
+        map_data.gate_dests = reader.read_array(np.uint32)
+        map_data.gate_materials = reader.read_array(np.uint32)
+
+        #Objects
+        map_data.objects = reader.read_array(np.float32, OBJECT_STRIDE)
+        map_data.object_meshes = reader.read_array(np.uint32)
+        map_data.object_materials = reader.read_array(np.uint32)
+        map_data.object_sounds = reader.read_array(np.uint32)
+
+        #Collision volumes
+        map_data.colboxes = reader.read_array(np.float32, COLBOX_STRIDE)
+        map_data.colspheres = reader.read_array(np.float32, COLSPHERE_STRIDE)
+        map_data.sphere_walls = reader.read_array(np.float32, 
+            SPHERE_WALL_STRIDE)
+        map_data.box_walls = reader.read_array(np.float32, BOX_WALL_STRIDE)
+
+        #Object groups
+        for i in range(reader.read_u32()):
+            mesh = reader.read_str()
+            material = reader.read_str()
+            transforms = reader.read_array(np.float32, OBJECT_STRIDE)
+            map_data.groups.append(ObjectGroupData(mesh, material, transforms))
+
+        return map_data
@@ -1,5 +1,7 @@
 """New Impressive Title - Utilities API"""
 
+import numpy as np
+
 
 #Functions
 #=============================================================================
@@ -23,4 +25,47 @@ def parse_vec(s, size = 3):
         return [float(value) for value in s.split(" ")]
 
     except ValueError:
-        return [0] * size
\ No newline at end of file
+        return [0] * size
+
+
+def parse_vec_array(strings, size = 3, max_size = None):
+    """Parse a column of vectors and return them as an array with a row for
+    each vector and max_size columns. Vectors with fewer than max_size values
+    are padded with NaN, and extra values are dropped. Upon failure, a vector
+    is parsed as size 0s, like parse_vec.
+    """
+    max_size = size if max_size is None else max_size
+    vecs = np.full((len(strings), max_size), np.nan)
+    counts = np.array([s.count(" ") for s in strings], int) + 1
+
+    #Parse all vectors with the same number of values at once
+    for count in np.unique(counts).tolist():
+        rows = np.flatnonzero(counts == count)
+        columns = min(count, max_size)
+
+        if count < size:
+            vecs[rows, :size] = 0
+            continue
+
+        try:
+            values = np.array(" ".join([strings[row] for row in rows]).split(" "),
+                np.float64).reshape(-1, count)
+            vecs[rows, :columns] = values[:, :columns]
+
+        #Fall back to parsing each vector on its own
+        except ValueError:
+            for row in rows.tolist():
+                values = parse_vec(strings[row], size)[:max_size]
+                vecs[row, :len(values)] = values
+
+    return vecs
+
+
+def exhaust(generator):
+    """Run a generator to completion and return its return value."""
+    while True:
+        try:
+            next(generator)
+
+        except StopIteration as e:
+            return e.value
@@ -1,22 +1,45 @@
 """New Impressive Title - World API"""
 
+import math
 import os
+from queue import Empty, Queue
+import threading
 import xml.etree.ElementTree as etree
 
 from direct.task.Task import Task
 from kivy.logger import Logger, LOG_LEVELS
+import numpy as np
 from panda3d.core import (
+    BoundingBox,
+    CardMaker,
+    ClockObject,
     CollisionNode,
     CollisionSphere,
+    ConfigVariableBool,
+    ConfigVariableDouble,
+    ConfigVariableInt,
     GeoMipTerrain,
+    GeomEnums,
+    LODNode,
     Material,
+    NodePath,
+    PNMImage,
+    Point3,
+    PStatCollector,
     RigidBodyCombiner,
+    Shader,
     Texture,
+    TexturePool,
     TextureStage,
+    TransparencyAttrib,
+    Vec3,
     Vec4
     )
 
-from utils import parse_float, parse_vec
+from collision import CollisionWorld
+from mapdata import (MapData, get_map_cache_file, load_map_data,
+    read_map_cache, stream_map_xml, write_map_cache)
+from utils import exhaust, parse_float
 
 
 #Constants
@@ -32,6 +55,191 @@ gate_mat_white.diffuse = Vec4(1, 1, 1, 1)
 gate_mat_white.specular = Vec4(0, 0, 0, 1)
 gate_mat_white.emission = Vec4(.5, .5, .5, 1)
 
+LOAD_FRAME_BUDGET = .005 #seconds of background loading per frame
+LOAD_PARSE_WEIGHT = .1 #fraction of the loading bar used for parsing
+LOAD_MODEL_WEIGHT = .3 #fraction of the loading bar used for model loading
+TERRAIN_MAX_UPDATE_INTERVAL = .5 #seconds between terrain LOD updates
+LOD_MAX_DISTANCE = 1e9 #far distance of the last level of detail
+TERRAIN_TEXTURE = "./data/textures/terrain/grass_tex2.png"
+
+collect_pcollector = PStatCollector("App:Scenery:Collect")
+
+scenery_instancing = ConfigVariableBool("scenery-instancing", True,
+    "Draw object groups with hardware instancing when it is supported.")
+terrain_lod_budget = ConfigVariableDouble("terrain-lod-budget", .004,
+    "The number of seconds a terrain LOD update may take each frame.")
+scenery_cell_size = ConfigVariableDouble("scenery-cell-size", 500,
+    "The size of each cell of the scenery grid.")
+scenery_collect_delay = ConfigVariableInt("scenery-collect-delay", 5,
+    "Frames a scenery cell must go unchanged before it is combined again.")
+scenery_collect_max_delay = ConfigVariableInt("scenery-collect-max-delay", 60,
+    "Frames a scenery cell that keeps changing can wait to be combined.")
+scenery_collects_per_frame = ConfigVariableInt("scenery-collects-per-frame", 1,
+    "The maximum number of scenery cells combined each frame.")
+scenery_collect_threaded = ConfigVariableBool("scenery-collect-threaded", 
+    False, "Combine scenery cells on a separate task chain thread.")
+scenery_view_distance = ConfigVariableDouble("scenery-view-distance", 2000,
+    "Scenery cells further than this from the camera are released.")
+texture_cache_budget = ConfigVariableInt("texture-cache-budget", 256,
+    "Megabytes of textures kept in the texture cache.")
+map_cache_budget = ConfigVariableInt("map-cache-budget", 64,
+    "Megabytes of map data kept for recently visited and prefetched maps.")
+trigger_cell_size = ConfigVariableDouble("trigger-cell-size", 250,
+    "The size of each cell of the spatial hash for portals and gates.")
+map_prefetch_distance = ConfigVariableDouble("map-prefetch-distance", 1000,
+    "Destination maps of portals and gates within this distance of the "
+    "camera are prefetched.")
+
+
+#Functions
+#==============================================================================
+def compose_instance_matrices(transforms):
+    """Compose the instance buffer data for an array of packed transforms.
+    Each instance gets 3 texels, where each texel holds one column of its
+    rotation/scale matrix followed by one coordinate of its position.
+    """
+    pos = transforms[:, 0:3]
+    h, p, r = np.radians(transforms[:, 3:6]).T
+    scale = transforms[:, 6:9]
+    n = len(transforms)
+
+    #Build the roll, pitch, and heading matrices (Panda3D row vector order)
+    ch, sh = np.cos(h), np.sin(h)
+    cp, sp = np.cos(p), np.sin(p)
+    cr, sr = np.cos(r), np.sin(r)
+    zero, one = np.zeros(n), np.ones(n)
+    rot_h = np.stack([ch, sh, zero, -sh, ch, zero, zero, zero, one], 1)
+    rot_p = np.stack([one, zero, zero, zero, cp, sp, zero, -sp, cp], 1)
+    rot_r = np.stack([cr, zero, -sr, zero, one, zero, sr, zero, cr], 1)
+
+    #Compose scale * roll * pitch * heading
+    mat = (scale[:, :, np.newaxis] * rot_r.reshape(n, 3, 3)) @ \
+        rot_p.reshape(n, 3, 3) @ rot_h.reshape(n, 3, 3)
+    return np.concatenate([mat.transpose(0, 2, 1), pos[:, :, np.newaxis]], 
+        2).astype(np.float32)
+
+
+def load_lod_levels(mesh, model):
+    """Load the LOD config for a scenery mesh. The config is an XML file named
+    "lod.xml" in the mesh's folder, for example:
+
+        <lod far="6000">
+            <level mesh="tree_low" distance="800"/>
+            <impostor texture="tree_impostor.png" distance="2000"/>
+        </lod>
+
+    The full mesh is shown until the first level's distance, and each level is
+    shown until the next one's distance. Impostors are camera-facing cards that
+    are sized to fit the full mesh. Return a list of LOD levels, or None if the
+    mesh has no LOD config.
+    """
+    #Load the LOD config
+    mesh_dir = os.path.join("./data/models/scenery", mesh)
+    lod_file = os.path.join(mesh_dir, "lod.xml")
+
+    if not os.path.exists(lod_file):
+        return None
+
+    try:
+        root = etree.parse(lod_file).getroot()
+
+    except etree.ParseError as e:
+        Logger.warning("Failed to parse LOD config '{}': {}".format(lod_file,
+            e))
+        return None
+
+    far = parse_float(root.attrib["far"]) if "far" in root.attrib else LOD_MAX_DISTANCE
+    levels = [LODLevel(model, 0, far)]
+
+    for child in root:
+        #Validate level
+        if "distance" not in child.attrib:
+            Logger.warning("LOD level must define 'distance'.")
+            continue
+
+        distance = parse_float(child.attrib["distance"])
+
+        #Simplified mesh?
+        if child.tag == "level" and "mesh" in child.attrib:
+            filename = os.path.join(mesh_dir, child.attrib["mesh"])
+
+            try:
+                level = LODLevel(loader.load_model(filename), distance, far, 
+                    False, filename)
+
+            except IOError:
+                Logger.warning("LOD mesh '{}' failed to load.".format(filename))
+                continue
+
+        #Impostor?
+        elif child.tag == "impostor" and "texture" in child.attrib:
+            texture = base.world_mgr.textures.get(
+                os.path.join(mesh_dir, child.attrib["texture"]))
+
+            if texture is None:
+                Logger.warning("Impostor texture for '{}' failed to load.".format(mesh))
+                continue
+
+            level = LODLevel(make_impostor(model, texture), distance, far, True)
+
+        #Unknown?
+        else:
+            Logger.warning("Unknown LOD level '{}' for mesh '{}'.".format(
+                child.tag, mesh))
+            continue
+
+        #The previous level ends where this one starts
+        levels[-1].far = distance
+        levels.append(level)
+
+    return levels
+
+
+def get_portal_texture_file(dest):
+    """Get the filename of the portal texture for the given destination map."""
+    return os.path.join("./data/maps", dest, "portal.png")
+
+
+def make_impostor(model, texture):
+    """Make an impostor card for a model. The card stands upright in the XZ
+    plane and covers the model's bounds.
+    """
+    tight_bounds = model.get_tight_bounds()
+
+    if tight_bounds is None:
+        lo, hi = Point3(-1, -1, 0), Point3(1, 1, 2)
+
+    else:
+        lo, hi = tight_bounds
+
+    half_width = max(hi.x - lo.x, hi.y - lo.y) / 2
+    cm = CardMaker("impostor")
+    cm.set_frame(-half_width, half_width, lo.z, hi.z)
+    card = NodePath(cm.generate())
+    card.set_texture(texture, 1)
+    card.set_transparency(TransparencyAttrib.M_binary)
+    return card
+
+
+def build_lod_prototype(mesh, levels):
+    """Build a prototype that switches between the given levels of detail."""
+    lod = LODNode("{}-lod".format(mesh))
+    prototype = NodePath(lod)
+
+    for level in levels:
+        lod.add_switch(level.far, level.near)
+
+        #Impostors need to turn to face the camera
+        if level.is_billboard:
+            holder = prototype.attach_new_node("impostor")
+            holder.set_billboard_axis()
+            level.model.instance_to(holder)
+
+        else:
+            level.model.instance_to(prototype)
+
+    return prototype
+
 
 #Classes
 #==============================================================================
@@ -44,12 +252,12 @@ class Portal(object):
         self.model.set_pos(*pos) #Y is up in the map data
         self.model.set_scale(radius, radius, radius)
 
-        try:
-            texture = loader.load_texture(
-                os.path.join("./data/maps", dest, "portal.png"))
+        texture = base.world_mgr.textures.get(get_portal_texture_file(dest))
+
+        if texture is not None:
             self.model.set_texture(texture, 1)
 
-        except IOError:
+        else:
             Logger.warning("No portal texture for map '{}'.".format(dest))
 
         self.model.reparent_to(base.world_mgr.scenery_np)
@@ -59,14 +267,17 @@ class Portal(object):
         cnode.add_solid(CollisionSphere(0, 0, 0, 1))
         self.collider = self.model.attach_new_node(cnode)
         self.collider.set_python_tag("object", self)
-        base.cTrav.add_collider(self.collider, base.portal_handler)
 
         #Store desination
         self.dest = dest
-
-    def __del__(self):
-        """Cleanup this portal."""
-        base.cTrav.remove_collider(self.collider)
+        self.radius = radius
+        self.trigger_cells = []
+
+    def destroy(self):
+        """Cleanup this portal. Its collider must already be removed from the
+        collision traverser.
+        """
+        self.collider.clear_python_tag("object")
         self.model.remove_node()
 
 
@@ -87,28 +298,716 @@ class Gate(Portal):
         self.model.set_material(gate_mat_black, 1) #need to adjust this later
 
 
+class LODLevel(object):
+    """A level of detail of a scenery mesh. The level is shown when the camera
+    is at least near and less than far units away.
+    """
+    def __init__(self, model, near, far, is_billboard = False, filename = None):
+        """Setup this level of detail."""
+        self.model = model
+        self.near = near
+        self.far = far
+        self.is_billboard = is_billboard
+        self.filename = filename
+
+
+class PrototypeCache(object):
+    """A cache of scenery model prototypes. Each mesh is loaded once and every
+    object that uses it gets an instance of the same prototype. Meshes with a
+    LOD config get a prototype that switches between their levels of detail.
+    """
+    def __init__(self):
+        """Setup this prototype cache."""
+        self.prototypes = {}
+        self.levels = {}
+        self.ref_counts = {}
+
+    def add_prototype(self, mesh, model):
+        """Add the prototype for the given mesh to this cache."""
+        self.prototypes[mesh] = model
+        self.levels[mesh] = [LODLevel(model, 0, LOD_MAX_DISTANCE)]
+        self.ref_counts[mesh] = 0
+
+        if model is None:
+            Logger.warning("Model '{}' failed to load.".format(mesh))
+            return
+
+        #Load the LOD config for the mesh
+        levels = load_lod_levels(mesh, model)
+
+        if levels is not None:
+            self.levels[mesh] = levels
+            self.prototypes[mesh] = build_lod_prototype(mesh, levels)
+            Logger.info("Loaded {} levels of detail for '{}'.".format(
+                len(levels), mesh))
+
+    def acquire(self, mesh):
+        """Return the prototype for the given mesh and increase its reference
+        count. Upon failure, return None.
+        """
+        #Load the prototype if needed
+        if mesh not in self.prototypes:
+            try:
+                model = loader.load_model(
+                    os.path.join("./data/models/scenery", mesh, mesh))
+
+            except IOError:
+                #Remember the failure so we don't retry for every instance
+                model = None
+
+            self.add_prototype(mesh, model)
+
+        self.ref_counts[mesh] += 1
+        return self.prototypes[mesh]
+
+    def get_levels(self, mesh):
+        """Get the levels of detail of the given mesh. Meshes without a LOD 
+        config have a single level.
+        """
+        return self.levels[mesh]
+
+    def release(self, mesh):
+        """Decrease the reference count of the given mesh."""
+        if mesh in self.ref_counts:
+            self.ref_counts[mesh] -= 1
+
+    def preload(self, meshes, callback):
+        """Load the prototypes for the given meshes with the async loader, then
+        call the callback. Preloaded prototypes are not referenced until they
+        are acquired.
+        """
+        meshes = [mesh for mesh in set(meshes) if mesh not in self.prototypes]
+
+        if len(meshes) == 0:
+            callback()
+            return
+
+        def on_loaded(models):
+            """Store the loaded prototypes."""
+            for mesh, model in zip(meshes, models):
+                if mesh not in self.prototypes:
+                    self.add_prototype(mesh, model if model else None)
+
+            callback()
+
+        loader.load_model(
+            [os.path.join("./data/models/scenery", mesh, mesh) 
+                for mesh in meshes],
+            callback = on_loaded
+            )
+
+    def instance(self, mesh, parent, lod_parent = None):
+        """Create a new instance of the given mesh under the given parent node
+        and return it. Meshes with levels of detail are instanced under the
+        LOD parent instead if there is one. Upon failure, return None.
+        """
+        prototype = self.acquire(mesh)
+
+        if prototype is None:
+            return None
+
+        if lod_parent is not None and len(self.levels[mesh]) > 1:
+            parent = lod_parent
+
+        model = parent.attach_new_node(mesh)
+        prototype.instance_to(model)
+        return model
+
+    def purge(self, keep = ()):
+        """Release all prototypes that are no longer used, except for the
+        meshes in keep.
+        """
+        keep = set(keep)
+
+        for mesh in [mesh for mesh, count in self.ref_counts.items() 
+            if count <= 0 and mesh not in keep]:
+            prototype = self.prototypes.pop(mesh)
+            levels = self.levels.pop(mesh)
+            del self.ref_counts[mesh]
+
+            if prototype is not None:
+                #The first level is always the full mesh
+                loader.unload_model(levels[0].model)
+
+                for level in levels[1:]:
+                    if level.filename is not None:
+                        loader.unload_model(level.filename)
+
+                for level in levels:
+                    level.model.remove_node()
+
+                if not prototype.is_empty():
+                    prototype.remove_node()
+
+            Logger.info("Released prototype '{}'.".format(mesh))
+
+
+class TextureCache(object):
+    """A cache of world textures. Each texture is loaded once and kept until
+    the cache grows past its memory budget, at which point the least recently
+    used textures are released. Missing textures are remembered as well, so
+    the filesystem is only probed once for each texture.
+    """
+    def __init__(self):
+        """Setup this texture cache."""
+        self.textures = {}
+        self.memory = 0
+        self.lock = threading.Lock()
+
+    def get(self, filename):
+        """Get the texture with the given filename, loading it if it isn't
+        cached yet. This is safe to call from a worker thread. If the texture
+        doesn't exist, return None.
+        """
+        filename = os.path.normpath(filename)
+
+        with self.lock:
+            #Move cached textures to the back of the eviction order
+            if filename in self.textures:
+                texture = self.textures.pop(filename)
+                self.textures[filename] = texture
+                return texture
+
+        #Load the texture
+        if os.path.exists(filename):
+            texture = TexturePool.load_texture(filename)
+
+        else:
+            texture = None
+
+        with self.lock:
+            if filename in self.textures:
+                return self.textures[filename]
+
+            self.textures[filename] = texture
+
+            if texture is not None:
+                self.memory += texture.estimate_texture_memory()
+                self.evict()
+
+        return texture
+
+    def preload(self, filenames):
+        """Load the given textures ahead of time. This is safe to call from a
+        worker thread.
+        """
+        for filename in filenames:
+            self.get(filename)
+
+        Logger.info("Texture cache: {} textures, {:.1f} MB".format(
+            len(self.textures), self.memory / 1048576))
+
+    def evict(self):
+        """Release the least recently used textures until this cache is within
+        its memory budget. The lock must already be held.
+        """
+        budget = texture_cache_budget.get_value() * 1048576
+
+        while self.memory > budget and len(self.textures) > 1:
+            filename = next(iter(self.textures))
+            texture = self.textures.pop(filename)
+
+            if texture is not None:
+                self.memory -= texture.estimate_texture_memory()
+                TexturePool.release_texture(texture)
+
+
+class MapCache(object):
+    """A cache of the map data of recently visited and prefetched maps. The
+    least recently used maps are dropped once the cache grows past its memory
+    budget.
+    """
+    def __init__(self):
+        """Setup this map cache."""
+        self.maps = {}
+        self.memory = 0
+
+    def __contains__(self, map):
+        """Check if the given map is cached."""
+        return os.path.normpath(map) in self.maps
+
+    def get(self, map):
+        """Get the map data of the given map. If the map isn't cached, return
+        None.
+        """
+        map = os.path.normpath(map)
+
+        if map not in self.maps:
+            return None
+
+        #Move the map to the back of the eviction order
+        map_data = self.maps.pop(map)
+        self.maps[map] = map_data
+        return map_data
+
+    def add(self, map, map_data):
+        """Add the map data of the given map to this cache."""
+        map = os.path.normpath(map)
+
+        if map in self.maps:
+            self.memory -= self.maps.pop(map).estimate_memory()
+
+        self.maps[map] = map_data
+        self.memory += map_data.estimate_memory()
+
+        #Drop the least recently used maps until the cache fits its budget
+        budget = map_cache_budget.get_value() * 1048576
+
+        while self.memory > budget and len(self.maps) > 1:
+            map = next(iter(self.maps))
+            self.memory -= self.maps.pop(map).estimate_memory()
+            Logger.info("Dropped cached map '{}'.".format(map))
+
+
 class Object(object):
-    """A scenery object."""
+    """A scenery object. The model of an object is only loaded while the
+    scenery cell it belongs to is active.
+    """
     def __init__(self, mesh, pos, rot, scale, material, sound):
         """Setup this scenery object."""
-        try:
-            #Setup model
-            self.model = loader.load_model(
-                os.path.join("./data/models/scenery", mesh, mesh))
-            self.model.set_pos(*pos)
-            self.model.set_hpr(*rot)
-            self.model.set_scale(*scale)
-            self.model.reparent_to(base.world_mgr.scenery_np)
-
-        except IOError:
-            #Just set this to None if the model won't load
-            self.model = None
-            Logger.warning("Model '{}' failed to load.".format(mesh))
-
-    def __del__(self):
+        self.mesh = mesh
+        self.pos = pos
+        self.rot = rot
+        self.scale = scale
+        self.material = material
+        self.sound = sound
+        self.cell = None
+        self.model = None
+        self.is_loaded = False
+
+    def destroy(self):
         """Cleanup this scenery object."""
+        self.unload()
+
+    def load(self, parent, lod_parent = None):
+        """Load the model for this object under the given parent node. If the
+        mesh has levels of detail, it is loaded under the LOD parent instead
+        if there is one.
+        """
+        if self.is_loaded:
+            return
+
+        self.model = base.world_mgr.prototypes.instance(self.mesh, parent,
+            lod_parent)
+        self.is_loaded = True
+
+        if self.model is not None:
+            self.model.set_pos(*self.pos)
+            self.model.set_hpr(*self.rot)
+            self.model.set_scale(*self.scale)
+
+    def unload(self):
+        """Unload the model for this object."""
+        if not self.is_loaded:
+            return
+
         if self.model is not None:
             self.model.remove_node()
+            self.model = None
+
+        base.world_mgr.prototypes.release(self.mesh)
+        self.is_loaded = False
+
+
+class SceneryCell(object):
+    """A cell of the scenery grid. Each cell has its own combiner so that it
+    can be culled, combined, and released independently. Changes to a cell
+    are debounced so that a burst of changes only causes a single collect.
+    """
+    def __init__(self, name):
+        """Setup this scenery cell."""
+        self.root = NodePath(name)
+        self.combiner = RigidBodyCombiner(name)
+        self.np = self.root.attach_new_node(self.combiner)
+
+        #Combining flattens LOD switches and billboards, so objects with
+        #levels of detail are kept out of the combiner
+        self.lod_np = self.root.attach_new_node("lod")
+
+        self.parent = None
+        self.objects = set()
+        self.removed = set()
+        self.is_active = False
+        self.is_dirty = False
+        self.is_collecting = False
+        self.has_changes = False
+        self.dirty_frame = 0
+        self.changed_frame = 0
+
+    def mark_dirty(self):
+        """Mark this cell as needing to be combined again."""
+        frame = ClockObject.get_global_clock().get_frame_count()
+
+        if not self.is_dirty:
+            self.is_dirty = True
+            self.dirty_frame = frame
+            base.world_mgr.dirty_cells.add(self)
+
+        self.changed_frame = frame
+
+    def is_ready(self, frame):
+        """Check if this cell has been left alone long enough to be combined.
+        Cells that keep changing are combined after a maximum delay.
+        """
+        return (frame - self.changed_frame >= scenery_collect_delay.get_value()
+            or frame - self.dirty_frame >= 
+            scenery_collect_max_delay.get_value())
+
+    def add_object(self, object):
+        """Add an object to this cell."""
+        self.objects.add(object)
+
+        #The combiner can't be changed while the scenery thread combines it
+        if self.is_collecting:
+            self.has_changes = True
+
+        elif self.is_active:
+            object.load(self.np, self.lod_np)
+            self.mark_dirty()
+
+    def remove_object(self, object):
+        """Remove an object from this cell."""
+        self.objects.discard(object)
+
+        if self.is_collecting:
+            self.removed.add(object)
+            self.has_changes = True
+            return
+
+        object.unload()
+
+        if self.is_active:
+            self.mark_dirty()
+
+    def activate(self, parent):
+        """Load the objects in this cell and attach it to the given parent."""
+        self.parent = parent
+        self.is_active = True
+
+        if self.is_collecting:
+            self.has_changes = True
+            return
+
+        for object in self.objects:
+            object.load(self.np, self.lod_np)
+
+        self.root.reparent_to(parent)
+        self.mark_dirty()
+
+    def deactivate(self):
+        """Detach this cell and release the models of its objects."""
+        self.is_active = False
+        self.is_dirty = False
+        base.world_mgr.dirty_cells.discard(self)
+
+        if self.is_collecting:
+            self.has_changes = True
+            return
+
+        for object in self.objects:
+            object.unload()
+
+        self.root.detach_node()
+        self.combiner.collect() #drop the combined copy of the old models
+
+    def finish_collect(self):
+        """Apply the changes that were held off while the scenery thread
+        combined this cell. The cell goes back on the dirty list if it is
+        still active.
+        """
+        self.is_collecting = False
+
+        if not self.has_changes:
+            return
+
+        self.has_changes = False
+
+        for object in self.removed:
+            object.unload()
+
+        self.removed.clear()
+
+        if self.is_active:
+            self.activate(self.parent)
+
+        else:
+            self.deactivate()
+
+    def collect(self):
+        """Combine the objects in this cell and return the time it took in
+        seconds.
+        """
+        clock = ClockObject.get_global_clock()
+        start = clock.get_real_time()
+        collect_pcollector.start()
+        self.combiner.collect()
+        collect_pcollector.stop()
+        return clock.get_real_time() - start
+
+
+class InstancedGroup(object):
+    """A group of scenery objects that share a mesh and are drawn with
+    hardware instancing. Each level of detail of the mesh is drawn in a single
+    draw call, and the shader hides the instances that are out of its range.
+    """
+    def __init__(self, mesh, transforms):
+        """Setup this instanced group. The transforms must have their heights
+        resolved already.
+        """
+        self.mesh = mesh
+        self.models = []
+        prototype = base.world_mgr.prototypes.acquire(mesh)
+
+        if prototype is None or len(transforms) == 0:
+            return
+
+        #Upload the instance transforms
+        data = compose_instance_matrices(transforms)
+        self.buffer = Texture("{}-instances".format(mesh))
+        self.buffer.setup_buffer_texture(len(transforms) * 3, Texture.T_float,
+            Texture.F_rgba32, GeomEnums.UH_static)
+        self.buffer.set_ram_image(data.tobytes())
+
+        #The prototype's bounds only cover a single instance, so we need to
+        #compute bounds that cover the whole group
+        levels = base.world_mgr.prototypes.get_levels(mesh)
+        tight_bounds = levels[0].model.get_tight_bounds()
+
+        if tight_bounds is None:
+            extent = 0
+
+        else:
+            extent = max(tight_bounds[0].length(), tight_bounds[1].length()
+                ) * np.abs(transforms[:, 6:9]).max(1, keepdims = True)
+
+        pos = transforms[:, 0:3]
+        lo = (pos - extent).min(0)
+        hi = (pos + extent).max(0)
+        bounds = BoundingBox(Point3(*lo.tolist()), Point3(*hi.tolist()))
+
+        #Setup a model for each level of detail
+        for level in levels:
+            model = level.model.copy_to(base.world_mgr.instances_np)
+            model.set_shader(base.world_mgr.instance_shader)
+            model.set_instance_count(len(transforms))
+            model.set_shader_input("instances", self.buffer)
+            model.set_shader_input("lod", Vec3(level.near, level.far, 
+                level.is_billboard))
+            model.node().set_bounds(bounds)
+            model.node().set_final(True)
+            self.models.append(model)
+
+    def destroy(self):
+        """Cleanup this instanced group."""
+        for model in self.models:
+            model.remove_node()
+
+        self.models = []
+        base.world_mgr.prototypes.release(self.mesh)
+
+
+class HeightField(object):
+    """A copy of a terrain heightfield that can be sampled in bulk. Heights
+    are interpolated the same way as GeoMipTerrain.get_elevation.
+    """
+    def __init__(self, image, size):
+        """Setup this heightfield from the given image and terrain size."""
+        #Copy the image into an array of normalized values
+        image = PNMImage(image)
+        image.remove_alpha()
+        tex = Texture("heightfield")
+        tex.load(image)
+        dtype = np.uint16 if tex.get_component_width() == 2 else np.uint8
+        data = np.frombuffer(memoryview(tex.get_ram_image()), dtype).reshape(
+            tex.get_y_size(), tex.get_x_size(), -1)
+        data = data[::-1].astype(np.float64) / np.iinfo(dtype).max
+
+        #Color heightfields store extra precision in the green and blue
+        #channels. Textures store color channels in BGR order.
+        if image.is_grayscale():
+            self.heights = data[:, :, 0]
+
+        else:
+            steps = image.get_maxval() + 1.0
+            self.heights = (data[:, :, 2] + data[:, :, 1] / steps + 
+                data[:, :, 0] / (steps * steps))
+
+        self.size = size
+
+    def get_heights(self, x, y):
+        """Get the heights at the given arrays of X and Y coordinates."""
+        #Convert to heightfield coordinates
+        rows, cols = self.heights.shape
+        x = np.asarray(x, np.float64) / (self.size[0] / 512)
+        y = (rows - 1) - np.asarray(y, np.float64) / (self.size[1] / 512)
+
+        #Points outside of the heightfield get the height of the nearest edge
+        x = np.clip(x, 0, cols - 1)
+        y = np.clip(y, 0, rows - 1)
+
+        #Find the surrounding pixels
+        xlo = np.clip(np.floor(x), 0, cols - 2).astype(np.intp)
+        ylo = np.clip(np.floor(y), 0, rows - 2).astype(np.intp)
+        xoffs = x - xlo
+        yoffs = y - ylo
+
+        #Interpolate between them
+        top = (self.heights[ylo, xlo] * (1 - xoffs) + 
+            self.heights[ylo, xlo + 1] * xoffs)
+        bottom = (self.heights[ylo + 1, xlo] * (1 - xoffs) + 
+            self.heights[ylo + 1, xlo + 1] * xoffs)
+        return (top * (1 - yoffs) + bottom * yoffs) * self.size[2]
+
+
+class TriggerGrid(object):
+    """A spatial hash of trigger volumes such as portals and gates. Only the
+    triggers in the cells around the watched nodes have active colliders, so
+    trigger checks scale with the local density of triggers rather than the
+    size of the map. Inactive colliders are stashed and kept out of the
+    collision traverser.
+    """
+    def __init__(self):
+        """Setup this trigger grid."""
+        self.cell_size = trigger_cell_size.get_value()
+        self.cells = {}
+        self.active = set()
+        self.watchers = []
+        self.watcher_cells = None
+
+    def get_cell_coords(self, x, y):
+        """Get the coordinates of the cell that contains the given point."""
+        return (int(x // self.cell_size), int(y // self.cell_size))
+
+    def add(self, trigger):
+        """Add a trigger to this grid. The trigger is added to every cell that
+        its radius overlaps.
+        """
+        trigger.collider.stash()
+        pos = trigger.model.get_pos()
+        x1, y1 = self.get_cell_coords(pos[0] - trigger.radius, 
+            pos[1] - trigger.radius)
+        x2, y2 = self.get_cell_coords(pos[0] + trigger.radius,
+            pos[1] + trigger.radius)
+        trigger.trigger_cells = [(x, y) 
+            for y in range(y1, y2 + 1) for x in range(x1, x2 + 1)]
+
+        for coords in trigger.trigger_cells:
+            self.cells.setdefault(coords, set()).add(trigger)
+
+        self.watcher_cells = None
+
+    def remove(self, trigger):
+        """Remove a trigger from this grid."""
+        for coords in trigger.trigger_cells:
+            cell = self.cells[coords]
+            cell.discard(trigger)
+
+            if len(cell) == 0:
+                del self.cells[coords]
+
+        trigger.trigger_cells = []
+
+        if trigger in self.active:
+            self.active.discard(trigger)
+            base.cTrav.remove_collider(trigger.collider)
+
+    def clear(self):
+        """Remove all triggers from this grid and return the colliders that
+        were active, which must still be removed from the collision traverser.
+        """
+        colliders = [trigger.collider for trigger in self.active]
+        self.cells.clear()
+        self.active.clear()
+        self.watcher_cells = None
+        return colliders
+
+    def watch(self, np):
+        """Activate the triggers near the given node."""
+        self.watchers.append(np)
+        self.watcher_cells = None
+
+    def unwatch(self, np):
+        """Stop activating the triggers near the given node."""
+        self.watchers.remove(np)
+        self.watcher_cells = None
+
+    def update(self):
+        """Activate the triggers in the cells around the watched nodes and
+        deactivate all other triggers.
+        """
+        #Only update the triggers when a watched node enters a new cell
+        watcher_cells = [self.get_cell_coords(*np.get_pos(render).get_xy())
+            for np in self.watchers]
+
+        if watcher_cells == self.watcher_cells:
+            return
+
+        self.watcher_cells = watcher_cells
+        nearby = set()
+
+        for x, y in watcher_cells:
+            for dy in (-1, 0, 1):
+                for dx in (-1, 0, 1):
+                    nearby.update(self.cells.get((x + dx, y + dy), ()))
+
+        #Deactivate the triggers that are no longer nearby
+        for trigger in self.active - nearby:
+            base.cTrav.remove_collider(trigger.collider)
+            trigger.collider.stash()
+
+        #Activate the triggers that are now nearby
+        for trigger in nearby - self.active:
+            trigger.collider.unstash()
+            base.cTrav.add_collider(trigger.collider, base.portal_handler)
+
+        self.active = nearby
+
+
+class EntityRegistry(object):
+    """A registry of world entities. Each entity is given an integer ID that
+    stays the same for as long as the entity exists and is never reused.
+    """
+    next_id = 1
+
+    def __init__(self):
+        """Setup this entity registry."""
+        self.entities = {}
+
+    def __len__(self):
+        """Return the number of entities in this registry."""
+        return len(self.entities)
+
+    def __iter__(self):
+        """Iterate over the entities in this registry."""
+        return iter(self.entities.values())
+
+    def __contains__(self, id):
+        """Check if an entity with the given ID is in this registry."""
+        return id in self.entities
+
+    def add(self, entity):
+        """Add an entity to this registry and return its ID."""
+        entity.id = EntityRegistry.next_id
+        EntityRegistry.next_id += 1
+        self.entities[entity.id] = entity
+        return entity.id
+
+    def remove(self, entity):
+        """Remove an entity from this registry and destroy it."""
+        del self.entities[entity.id]
+        entity.destroy()
+
+    def get(self, id):
+        """Get the entity with the given ID. Return None if there isn't one."""
+        return self.entities.get(id)
+
+    def clear(self):
+        """Destroy every entity in this registry."""
+        entities = self.entities
+        self.entities = {}
+
+        for entity in entities.values():
+            entity.destroy()
 
 
 class WorldManager(object):
@@ -118,195 +1017,549 @@ class WorldManager(object):
         Logger.info("Initializing world manager...")
 
         self.terrain = None
-        self.portals = []
-        self.gates = []
-        self.objects = []
-        self.scenery = RigidBodyCombiner("scenery")
-        self.scenery_np = render.attach_new_node(self.scenery)
-        self.is_dirty = True
+        self.terrain_lod = False
+        self.heightfield = None
+        self.collision = None
+        self.portals = EntityRegistry()
+        self.gates = EntityRegistry()
+        self.objects = EntityRegistry()
+        self.groups = EntityRegistry()
+        self.prototypes = PrototypeCache()
+        self.textures = TextureCache()
+        self.map_cache = MapCache()
+        self.triggers = TriggerGrid()
+        self.triggers.watch(base.camera)
+        self.scenery_np = render.attach_new_node("scenery")
+        self.cells = []
+        self.grid_size = (0, 0)
+        self.cell_size = 1
+        self.camera_cell = None
+        self.dirty_cells = set()
+        self.collect_count = 0
+        self.collect_time = 0
+        self.last_collect_time = 0
+
+        #Setup threaded scenery combining
+        if scenery_collect_threaded:
+            self.collect_queue = Queue()
+            self.collected_queue = Queue()
+            base.task_mgr.setupTaskChain("scenery", numThreads = 1)
+            base.task_mgr.add(self.run_collect, taskChain = "scenery")
+
+        #Setup hardware instancing for object groups if it is supported
+        gsg = base.win.get_gsg() if base.win is not None else None
+        self.use_instancing = bool(scenery_instancing and gsg is not None and
+            gsg.get_supports_geometry_instancing() and 
+            gsg.get_supports_buffer_texture())
+        self.instances_np = render.attach_new_node("instances")
+
+        if self.use_instancing:
+            self.instance_shader = Shader.load(Shader.SL_GLSL,
+                vertex = "./data/shaders/instanced.vert",
+                fragment = "./data/shaders/instanced.frag")
+            Logger.info("Hardware instancing enabled for object groups.")
+
+        self.load_task = None
+        self.load_steps = None
+        self.load_callback = None
+        self.load_progress = None
+
+        #Setup map prefetching
+        self.prefetching = set()
+        self.prefetch_cell = None
+        self.prefetch_queue = Queue()
+        self.prefetched_queue = Queue()
+        threading.Thread(target = self.run_prefetch, daemon = True).start()
 
         base.task_mgr.add(self.run_logic)
 
         Logger.info("World manager initialized.")
 
+    def get_map_file(self, map):
+        """Return the path of the XML file for the given map. Upon failure,
+        return None.
+        """
+        map_file = os.path.join(map, os.path.basename(map) + ".xml")
+
+        if not os.path.exists(map_file):
+            Logger.error("Failed to load map file '{}'.".format(map_file))
+            return None
+
+        return map_file
+
     def load_map(self, map):
         """Load a map."""
-        #Unload the current map first
-        self.unload_map()
+        #Unload the current map first. Prototypes are kept until the new map
+        #is loaded so that meshes shared by both maps are not reloaded.
+        self.cancel_load()
+        self.unload_map(False)
 
         #Locate the XML file for the map
         Logger.info("Loading map '{}'...".format(map))
-        map_file = os.path.join(map, os.path.basename(map) + ".xml")
+        map_file = self.get_map_file(map)
 
-        if not os.path.exists(map_file):
-            Logger.error("Failed to load map file '{}'.".format(map_file))
+        if map_file is None:
+            return False
+
+        #Build the map from its cached or compiled map data if it is up to
+        #date. Otherwise build it while its XML file is parsed.
+        map_data = self.map_cache.get(map)
+
+        if map_data is None:
+            map_data = read_map_cache(get_map_cache_file(map_file), map_file)
+
+            if map_data is None:
+                return exhaust(self.build_map_xml(map, map_file))
+
+            self.textures.preload(self.get_texture_manifest(map_data))
+            self.map_cache.add(map, map_data)
+
+        return exhaust(self.build_map(map, map_data))
+
+    def load_map_async(self, map, callback = None, progress = None):
+        """Load a map in the background. The compiled map data is read and its
+        textures are preloaded on a worker thread, its models are loaded with
+        the async loader, and its entities are added a few at a time each
+        frame. A map that hasn't been compiled yet is parsed a few elements at
+        a time each frame instead. The progress function is called each frame
+        with the fraction of the map that has been loaded and the callback is
+        called with True or False once the load has finished. The callback is
+        also called with False if the load is cancelled.
+        """
+        #Unload the current map first
+        self.cancel_load()
+        self.unload_map(False)
+
+        #Start loading the map
+        Logger.info("Loading map '{}' in the background...".format(map))
+        self.load_steps = self.stream_map(map)
+        self.load_callback = callback
+        self.load_progress = progress
+        self.load_task = base.task_mgr.add(self.run_load)
+
+    def cancel_load(self):
+        """Cancel the current background map load if there is one. Its
+        callback is called with False.
+        """
+        if self.load_task is not None:
+            self.load_task.remove()
+            self.load_task = None
+            self.load_steps = None
+            Logger.info("Background map load cancelled.")
+
+            if self.load_callback is not None:
+                self.load_callback(False)
+
+    def stream_map(self, map):
+        """Stream a map in. This is a generator that yields None while it is
+        waiting for work on another thread and the fraction of the map that
+        has been loaded after each step. It returns True if the map was
+        loaded successfully.
+        """
+        #Locate the XML file for the map
+        map_file = self.get_map_file(map)
+
+        if map_file is None:
             return False
 
-        #Load the map XML file
-        xml = etree.parse(map_file)
-        root = xml.getroot()
-
-        for child in root:
-            #Terrain?
-            if child.tag == "terrain":
-                #Validate terrain
-                if not ("size" in child.attrib and "spawnpos" in child.attrib
-                    and "heightmap" in child.attrib):
-                    Logger.error("Terrain section must define 'size', 'spawnpos', and 'heightmap'.")
+        #Use the map data of a recently visited or prefetched map if there is
+        #one. Otherwise read the compiled map data and preload its textures on
+        #a worker thread.
+        map_data = self.map_cache.get(map)
+
+        if map_data is None:
+            result = []
+
+            def read_map():
+                map_data = read_map_cache(get_map_cache_file(map_file), 
+                    map_file)
+
+                if map_data is not None:
+                    self.textures.preload(self.get_texture_manifest(map_data))
+
+                result.append(map_data)
+
+            thread = threading.Thread(target = read_map, daemon = True)
+            thread.start()
+
+            while thread.is_alive():
+                yield None
+
+            map_data = result[0] if len(result) > 0 else None
+
+            #Build the map while its XML file is parsed if it hasn't been
+            #compiled yet
+            if map_data is None:
+                return (yield from self.build_map_xml(map, map_file))
+
+            self.map_cache.add(map, map_data)
+
+        yield LOAD_PARSE_WEIGHT
+
+        #Load the models with the async loader
+        pending = [True]
+        self.prototypes.preload(map_data.get_meshes(), pending.clear)
+
+        while len(pending) > 0:
+            yield None
+
+        yield LOAD_PARSE_WEIGHT + LOAD_MODEL_WEIGHT
+
+        #Build the map
+        steps = self.build_map(map, map_data)
+        scale = 1 - LOAD_PARSE_WEIGHT - LOAD_MODEL_WEIGHT
+
+        while True:
+            try:
+                fraction = next(steps)
+
+            except StopIteration as e:
+                return e.value
+
+            yield LOAD_PARSE_WEIGHT + LOAD_MODEL_WEIGHT + fraction * scale
+
+    def run_load(self, task):
+        """Run the next steps of the current background map load. Steps are
+        run until the frame budget is used up.
+        """
+        clock = ClockObject.get_global_clock()
+        deadline = clock.get_real_time() + LOAD_FRAME_BUDGET
+        fraction = None
+
+        try:
+            while clock.get_real_time() < deadline:
+                step = next(self.load_steps)
+
+                #Waiting on another thread?
+                if step is None:
+                    break
+
+                fraction = step
+
+        except StopIteration as e:
+            #Loading finished
+            self.load_task = None
+            self.load_steps = None
+
+            if self.load_progress is not None:
+                self.load_progress(1)
+
+            if self.load_callback is not None:
+                self.load_callback(bool(e.value))
+
+            return Task.done
+
+        #Report progress
+        if fraction is not None and self.load_progress is not None:
+            self.load_progress(fraction)
+
+        return Task.cont
+
+    def get_texture_manifest(self, map_data):
+        """Get the filenames of the textures used by the given map data."""
+        manifest = [TERRAIN_TEXTURE] if map_data.terrain is not None else []
+        dests = set(map_data.portal_dests.tolist())
+        dests.update(map_data.gate_dests.tolist())
+        manifest += [get_portal_texture_file(map_data.strings[dest]) 
+            for dest in sorted(dests)]
+        return manifest
+
+    def build_map(self, map, map_data):
+        """Build the entities of a map from its map data. This is a generator
+        that yields the fraction of the map that has been built after each
+        entity and returns True if the map was built successfully.
+        """
+        #Count the steps needed to build the map
+        total = (1 + len(map_data.portals) + len(map_data.gates) + 
+            len(map_data.objects))
+
+        for group in map_data.groups:
+            total += 1 if self.use_instancing else len(group.transforms)
+
+        #Load terrain
+        if map_data.terrain is not None:
+            if not self.load_terrain(map, map_data.terrain):
+                return False
+
+        self.setup_cells()
+        done = 1
+        yield done / total
+
+        #Load portals
+        strings = map_data.strings
+
+        for portal, dest in zip(map_data.portals.tolist(), 
+            map_data.portal_dests.tolist()):
+            self.add_portal(portal[:3], portal[3], strings[dest])
+            done += 1
+            yield done / total
+
+        #Load gates
+        for gate, dest, material in zip(map_data.gates.tolist(),
+            map_data.gate_dests.tolist(), map_data.gate_materials.tolist()):
+            self.add_gate(gate[:3], strings[dest], gate[3:], 
+                strings[material])
+            done += 1
+            yield done / total
+
+        #Load objects
+        objects = self.ground_transforms(map_data.objects)
+
+        for obj, mesh, material, sound in zip(objects.tolist(),
+            map_data.object_meshes.tolist(), 
+            map_data.object_materials.tolist(),
+            map_data.object_sounds.tolist()):
+            self.add_object(strings[mesh], obj[0:3], obj[3:6], obj[6:9], 
+                strings[material], strings[sound])
+            done += 1
+            yield done / total
+
+        #Load object groups
+        for group in map_data.groups:
+            for step in self.load_object_group(group):
+                done += 1
+                yield done / total
+
+        #Build the collision world
+        self.collision = CollisionWorld.from_map_data(map_data)
+
+        #Release prototypes that the new map doesn't use. Objects only
+        #reference their models once their cell activates, so the meshes of
+        #the new map are kept even if nothing references them yet.
+        self.prototypes.purge(map_data.get_meshes())
+
+        #Map loaded
+        Logger.info("Map '{}' loaded.".format(map))
+        return True
+
+    def build_map_xml(self, map, map_file):
+        """Build the entities of a map while its XML file is parsed. Each
+        entity is added as soon as its element has been parsed, so the map
+        starts to appear before the whole file has been read. This is a
+        generator that yields the fraction of the file that has been parsed
+        after each entity and returns True if the map was built successfully.
+        Once the map has been built, its map data is compiled so that the next
+        load can skip parsing.
+        """
+        map_data = MapData()
+        steps = stream_map_xml(map_file, map_data)
+        strings = map_data.strings
+        pending = []
+
+        while True:
+            try:
+                kind, index, fraction = next(steps)
+
+            except StopIteration as e:
+                if not e.value:
+                    Logger.error("Failed to parse map file '{}'.".format(
+                        map_file))
                     return False
 
-                #Load terrain
-                self.size = parse_vec(child.attrib["size"], 3)
-                self.spawnpos = parse_vec(child.attrib["spawnpos"], 2)
-                heightmap = os.path.join(map, child.attrib["heightmap"])
-
-                self.terrain = GeoMipTerrain("Terrain")
-                self.terrain.set_block_size(64)
-                self.terrain.set_bruteforce(True)
-                
-                if not self.terrain.set_heightfield(heightmap):
-                    Logger.error("Failed to load heightmap for terrain.")
-                    self.terrain = None
+                break
+
+            #Load terrain. The scenery cells cover the terrain, so they are
+            #setup once it is loaded.
+            if kind == "terrain":
+                if not self.load_terrain(map, map_data.terrain):
                     return False
 
-                self.terrain_np = self.terrain.get_root()
-                self.terrain_np.set_scale(self.size[0] / 512, self.size[1] / 512, 
-                    self.size[2])
-                tex = loader.load_texture(
-                    "./data/textures/terrain/grass_tex2.png")
-                self.terrain_np.set_texture(tex)
-                self.terrain_np.set_tex_scale(TextureStage.get_default(), 
-                    self.size[0] / 512, self.size[1] / 512)
-                tex.set_wrap_u(Texture.WM_repeat)
-                tex.set_wrap_v(Texture.WM_repeat)
-                self.terrain_np.reparent_to(render)
-                self.terrain.generate()
-
-                base.camera.set_pos(self.size[0] / 2, self.size[1] / 2, 
-                    self.size[2])
-
-            #Portal?
-            elif child.tag == "portal":
-                #Validate portal
-                if not ("pos" in child.attrib and "destmap" in child.attrib):
-                    Logger.warning("Portal must define 'pos' and 'destmap'.")
-                    continue
+                self.setup_cells()
 
-                #Load portal
-                pos = parse_vec(child.attrib["pos"], 3)
-                radius = parse_float(child.attrib["radius"]) if "radius" in child.attrib else 1
-                destmap = child.attrib["destmap"]
-                self.add_portal(pos, radius, destmap)
-
-            #Gate?
-            elif child.tag == "gate":
-                #Validate gate
-                if not ("pos" in child.attrib and "destmap" in child.attrib and
-                    "destvec" in child.attrib):
-                    Logger.warning("Gate must define 'pos', 'destmap', and 'destvec'.")
-                    continue
+            #Load portal
+            elif kind == "portal":
+                portal = map_data.portals[index]
+                self.add_portal(portal[:3], portal[3], 
+                    strings[map_data.portal_dests[index]])
 
-                #Load gate
-                pos = parse_vec(child.attrib["pos"], 3)
-                destmap = child.attrib["destmap"]
-                destvec = parse_vec(child.attrib["destvec"], 3)
-                material = child.attrib["material"] if "material" in child.attrib else ""
-                self.add_gate(pos, destmap, destvec, material)
-
-            #Object?
-            elif child.tag == "object":
-                #Validate object
-                if not ("mesh" in child.attrib and "pos" in child.attrib):
-                    Logger.warning("Object must define 'mesh' and 'pos'.")
-                    continue
+            #Load gate
+            elif kind == "gate":
+                gate = map_data.gates[index]
+                self.add_gate(gate[:3], strings[map_data.gate_dests[index]],
+                    gate[3:], strings[map_data.gate_materials[index]])
 
-                #Load object
-                mesh = child.attrib["mesh"]
-                pos = parse_vec(child.attrib["pos"], 3)
-                rot = parse_vec(child.attrib["rot"], 3) if "rot" in child.attrib else [0, 0, 0]
-                scale = parse_vec(child.attrib["scale"], 3) if "scale" in child.attrib else [1, 1, 1]
-                material = child.attrib["material"] if "material" in child.attrib else ""
-                sound = child.attrib["sound"] if "sound" in child.attrib else ""
-                self.add_object(mesh, pos, rot, scale, material, sound)
-
-            #Object Group?
-            elif child.tag == "objectgroup":
-                #Validate object group
-                if not ("mesh" in child.attrib):
-                    Logger.warning("Object group must define 'mesh'.")
-                    continue
+            #Scenery is placed on the terrain and sorted into the cells that
+            #cover it, so scenery found before the terrain waits for it
+            elif kind in ("object", "objectgroup"):
+                pending.append((kind, index))
 
-                #Load object group
-                mesh = child.attrib["mesh"]
-                material = child.attrib["material"] if "material" in child.attrib else ""
-                self.load_object_group(child, mesh, material)
+            if len(self.cells) > 0:
+                for scenery in pending:
+                    for step in self.build_scenery(map_data, *scenery):
+                        yield fraction
 
-            #Unknown?
-            else:
-                Logger.warning(
-                    "Unknown tag '{}' encountered in map '{}'.".format(
-                        child.tag, map))
+                pending = []
+
+            yield fraction
+
+        #Add the scenery of maps without terrain
+        if len(self.cells) == 0:
+            self.setup_cells()
+
+            for scenery in pending:
+                for step in self.build_scenery(map_data, *scenery):
+                    yield fraction
+
+        #Compile the map data for the next load and build the collision world
+        map_data.pack()
+        write_map_cache(get_map_cache_file(map_file), map_file, map_data)
+        self.map_cache.add(map, map_data)
+        self.collision = CollisionWorld.from_map_data(map_data)
+
+        #Release prototypes that the new map doesn't use. Objects only
+        #reference their models once their cell activates, so the meshes of
+        #the new map are kept even if nothing references them yet.
+        self.prototypes.purge(map_data.get_meshes())
 
         #Map loaded
         Logger.info("Map '{}' loaded.".format(map))
         return True
 
-    def unload_map(self):
-        """Unload the current map."""
+    def build_scenery(self, map_data, kind, index):
+        """Add the object or object group at the given index of a map's data.
+        This is a generator that yields after each step.
+        """
+        strings = map_data.strings
+
+        if kind == "object":
+            obj = self.ground_transforms([map_data.objects[index]])[0]
+            self.add_object(strings[map_data.object_meshes[index]], 
+                obj[0:3].tolist(), obj[3:6].tolist(), obj[6:9].tolist(),
+                strings[map_data.object_materials[index]],
+                strings[map_data.object_sounds[index]])
+            yield
+
+        else:
+            yield from self.load_object_group(map_data.groups[index])
+
+    def load_terrain(self, map, terrain):
+        """Load the terrain for a map."""
+        self.size = terrain.size
+        self.spawnpos = terrain.spawnpos
+        heightmap = os.path.join(map, terrain.heightmap)
+
+        self.terrain = GeoMipTerrain("Terrain")
+        self.terrain.set_block_size(terrain.block_size)
+        self.terrain.set_bruteforce(not terrain.lod)
+        self.terrain_lod = terrain.lod
+        
+        if not self.terrain.set_heightfield(heightmap):
+            Logger.error("Failed to load heightmap for terrain.")
+            self.terrain = None
+            return False
+
+        self.heightfield = HeightField(self.terrain.heightfield(), self.size)
+        self.terrain_np = self.terrain.get_root()
+        self.terrain_np.set_scale(self.size[0] / 512, self.size[1] / 512, 
+            self.size[2])
+        tex = self.textures.get(TERRAIN_TEXTURE)
+
+        if tex is not None:
+            self.terrain_np.set_texture(tex)
+            self.terrain_np.set_tex_scale(TextureStage.get_default(), 
+                self.size[0] / 512, self.size[1] / 512)
+            tex.set_wrap_u(Texture.WM_repeat)
+            tex.set_wrap_v(Texture.WM_repeat)
+
+        else:
+            Logger.warning("Failed to load terrain texture.")
+        self.terrain_np.reparent_to(render)
+
+        #Setup level of detail. The LOD distances are given in world units,
+        #but the terrain measures them in heightfield pixels.
+        if terrain.lod:
+            scale = self.size[0] / 512
+            self.terrain.set_near_far(terrain.lod_near / scale, 
+                terrain.lod_far / scale)
+            self.terrain.set_min_level(0)
+            self.terrain.set_focal_point(base.camera)
+            self.terrain_update_interval = 0
+            self.terrain_update_time = 0
+            Logger.info("Terrain LOD enabled: near = {}, far = {}".format(
+                terrain.lod_near, terrain.lod_far))
+
+        self.terrain.generate()
+
+        base.camera.set_pos(self.size[0] / 2, self.size[1] / 2, 
+            self.size[2])
+        return True
+
+    def unload_map(self, purge = True):
+        """Unload the current map. If purge is True, prototypes that are no
+        longer used will also be released.
+        """
         if self.terrain is not None:
             self.terrain.get_root().remove_node()
 
         self.terrain = None
+        self.heightfield = None
+        self.collision = None
         self.size = [0, 0]
         self.spawnpos = [0, 0, 0]
 
-        while len(self.portals) > 0:
-            self.del_portal(self.portals[-1])
-
-        while len(self.gates) > 0:
-            self.del_gate(self.gates[-1])
-
-        while len(self.objects) > 0:
-            self.del_object(self.objects[-1])
-
-    def load_object_group(self, group, mesh, material):
-        """Load a group of objects."""
-        for object in group:
-            #Validate object
-            if not ("pos" in object.attrib):
-                Logger.warning("Group object must define 'pos'.")
-                continue
-
-            #Load object
-            pos = parse_vec(object.attrib["pos"], 2)
-            rot = parse_vec(object.attrib["rot"], 1) if "rot" in object.attrib else [0, 0, 0]
-            scale = parse_vec(object.attrib["scale"], 1) if "scale" in object.attrib else [1, 1, 1]
-            self.add_object(mesh, pos, rot, scale, material, "")
+        #Tear down all entities. The scenery cells are released as a whole,
+        #so the objects don't need to be removed from them one at a time. The
+        #scenery thread must be done with the cells first though.
+        self.wait_for_collects()
+        self.remove_colliders(self.triggers.clear())
+        self.portals.clear()
+        self.gates.clear()
+        self.objects.clear()
+        self.groups.clear()
+        self.clear_cells()
+
+        if purge:
+            self.prototypes.purge()
+
+    def load_object_group(self, group):
+        """Load a group of objects. This is a generator that yields after each
+        step of the load.
+        """
+        #Place the whole group on the terrain at once
+        transforms = self.ground_transforms(group.transforms)
+
+        #Draw the whole group with hardware instancing?
+        if self.use_instancing:
+            self.groups.add(InstancedGroup(group.mesh, transforms))
+            Logger.info("Added instanced group: mesh = '{}', count = {}".format(
+                group.mesh, len(transforms)))
+            yield
+            return
+
+        #Add each object separately
+        for transform in transforms.tolist():
+            self.add_object(group.mesh, transform[0:3], transform[3:6],
+                transform[6:9], group.material, "")
+            yield
 
     def add_portal(self, pos, radius, dest):
         """Add a portal to this world."""
-        self.portals.append(Portal(pos, radius, dest))
-        self.is_dirty = True
-        Logger.info("Added portal: pos = {}, radius = {}, dest = '{}'".format(
-            pos, radius, dest))
+        portal = Portal(pos, radius, dest)
+        self.portals.add(portal)
+        self.triggers.add(portal)
+        Logger.info("Added portal {}: pos = {}, radius = {}, dest = '{}'".format(
+            portal.id, pos, radius, dest))
+        return portal
 
     def del_portal(self, portal):
         """Remove a portal from this world."""
+        self.triggers.remove(portal)
         self.portals.remove(portal)
-        self.is_dirty = True
-        Logger.info("Removed portal {}".format(portal))
+        Logger.info("Removed portal {}".format(portal.id))
 
     def add_gate(self, pos, dest, destvec, material):
         """Add a gate to this world."""
-        self.gates.append(Gate(pos, dest, destvec, material))
-        self.is_dirty = True
-        Logger.info("Added gate: pos = {}, dest = '{}', destvec = {}, material = '{}'".format(pos, dest, destvec, material))
+        gate = Gate(pos, dest, destvec, material)
+        self.gates.add(gate)
+        self.triggers.add(gate)
+        Logger.info("Added gate {}: pos = {}, dest = '{}', destvec = {}, material = '{}'".format(gate.id, pos, dest, destvec, material))
+        return gate
 
     def del_gate(self, gate):
         """Remove a gate from this world."""
+        self.triggers.remove(gate)
         self.gates.remove(gate)
-        self.is_dirty = True
-        Logger.info("Removed gate {}".format(gate))
+        Logger.info("Removed gate {}".format(gate.id))
 
     def add_object(self, mesh, pos, rot, scale, material, sound):
         """Add an object to this world."""
@@ -325,37 +1578,318 @@ class WorldManager(object):
         elif len(scale) == 2:
             scale = [scale[0], scale[1], 1]
 
-        #Add the object
-        self.objects.append(Object(mesh, pos, rot, scale, material, sound))
-        self.is_dirty = True
-        Logger.info("Added object: mesh = '{}', pos = {}, rot = {}, scale = {}, material = '{}', sound = '{}'".format(mesh, pos, rot, scale, material, sound))
+        #Add the object to the cell that contains it
+        cell = self.get_cell(pos)
+
+        if cell is None:
+            Logger.error("Cannot add an object without a map.")
+            return None
+
+        object = Object(mesh, pos, rot, scale, material, sound)
+        object.cell = cell
+        cell.add_object(object)
+        self.objects.add(object)
+        Logger.info("Added object {}: mesh = '{}', pos = {}, rot = {}, scale = {}, material = '{}', sound = '{}'".format(object.id, mesh, pos, rot, scale, material, sound))
+        return object
 
     def del_object(self, object):
         """Delete an object from this world."""
+        object.cell.remove_object(object)
         self.objects.remove(object)
-        self.is_dirty = True
-        Logger.info("Removed object {}".format(object))
+        Logger.info("Removed object {}".format(object.id))
+
+    def get_entity(self, id):
+        """Get the portal, gate, object, or object group with the given ID.
+        Return None if there isn't one.
+        """
+        for registry in (self.portals, self.gates, self.objects, self.groups):
+            if id in registry:
+                return registry.get(id)
+
+        return None
+
+    def remove_colliders(self, colliders):
+        """Remove many colliders from the collision traverser at once. This
+        rebuilds the collider list in a single pass instead of searching it
+        once for each collider.
+        """
+        if len(colliders) == 0:
+            return
+
+        colliders = set(colliders)
+        keep = [(collider, base.cTrav.get_handler(collider)) 
+            for collider in base.cTrav.get_colliders() 
+            if collider not in colliders]
+        base.cTrav.clear_colliders()
+
+        for collider, handler in keep:
+            base.cTrav.add_collider(collider, handler)
+
+    def ground_transforms(self, transforms):
+        """Return a copy of the given packed transforms with every NaN height
+        replaced by the height of the terrain.
+        """
+        transforms = np.array(transforms, np.float32)
+        rows = np.isnan(transforms[:, 2])
+
+        if rows.any():
+            transforms[rows, 2] = self.get_terrain_heights(
+                transforms[rows, 0], transforms[rows, 1])
+
+        return transforms
 
     def get_terrain_height(self, pos):
         """Get the height of the terrain at the given point."""
-        #Is the position a list of 2 elements?
-        if isinstance(pos, list) and len(pos) == 2:
-            return self.terrain.get_elevation(
-                pos[0] / (self.size[0] / 512), 
-                pos[1] / (self.size[1] / 512)) * self.size[2]
+        return float(self.get_terrain_heights([pos[0]], [pos[1]])[0])
+
+    def get_terrain_heights(self, x, y):
+        """Get the heights of the terrain at the given arrays of X and Y
+        coordinates.
+        """
+        if self.heightfield is None:
+            return np.zeros(np.shape(x))
+
+        return self.heightfield.get_heights(x, y)
+
+    def setup_cells(self):
+        """Split the scenery into a grid of cells that covers the map."""
+        self.clear_cells()
+        self.cell_size = scenery_cell_size.get_value()
+        self.grid_size = (
+            max(1, int(math.ceil(self.size[0] / self.cell_size))),
+            max(1, int(math.ceil(self.size[1] / self.cell_size)))
+            )
+        self.cells = [SceneryCell("scenery-{}-{}".format(x, y)) 
+            for y in range(self.grid_size[1]) for x in range(self.grid_size[0])]
+        Logger.info("Scenery split into {}x{} cells.".format(*self.grid_size))
+
+    def clear_cells(self):
+        """Release all scenery cells."""
+        for cell in self.cells:
+            cell.deactivate()
+
+        self.cells = []
+        self.dirty_cells.clear()
+        self.grid_size = (0, 0)
+        self.camera_cell = None
+        self.prefetch_cell = None
+
+    def get_cell_coords(self, pos):
+        """Get the grid coordinates of the cell that contains the given point.
+        Points outside of the map belong to the nearest edge cell.
+        """
+        x = min(max(int(pos[0] // self.cell_size), 0), self.grid_size[0] - 1)
+        y = min(max(int(pos[1] // self.cell_size), 0), self.grid_size[1] - 1)
+        return (x, y)
+
+    def get_cell(self, pos):
+        """Get the cell that contains the given point. If there are no cells,
+        return None.
+        """
+        if len(self.cells) == 0:
+            return None
+
+        x, y = self.get_cell_coords(pos)
+        return self.cells[y * self.grid_size[0] + x]
+
+    def update_cells(self):
+        """Activate the cells within view distance of the camera and release
+        all other cells.
+        """
+        #Only update the cells when the camera enters a new cell
+        camera_cell = self.get_cell_coords(base.camera.get_pos(render))
+
+        if camera_cell == self.camera_cell:
+            return
+
+        self.camera_cell = camera_cell
+        view_dist = scenery_view_distance.get_value() / self.cell_size
+
+        for i, cell in enumerate(self.cells):
+            x = i % self.grid_size[0] - camera_cell[0]
+            y = i // self.grid_size[0] - camera_cell[1]
+            in_range = math.hypot(x, y) <= view_dist
+
+            if in_range and not cell.is_active:
+                cell.activate(self.scenery_np)
+
+            elif not in_range and cell.is_active:
+                cell.deactivate()
+
+    def update_prefetch(self):
+        """Prefetch the destination maps of the portals and gates near the
+        camera. Prefetched maps are parsed and their textures are loaded on a
+        worker thread, then their models are loaded with the async loader.
+        """
+        #Store the maps that finished prefetching
+        while not self.prefetched_queue.empty():
+            map, map_data = self.prefetched_queue.get()
+
+            #Maps that failed to load are left in the prefetch set so that
+            #they aren't tried again
+            if map_data is None:
+                continue
 
-        #Assume it is a point object
-        else:
-            return self.terrain.get_elevation(
-                pos[0] / (self.size[0] / 512), 
-                pos[1] / (self.size[1] / 512)) * self.size[2]
+            self.prefetching.discard(map)
+            self.map_cache.add(map, map_data)
+            self.prototypes.preload(map_data.get_meshes(), lambda: None)
+            Logger.info("Prefetched map '{}'.".format(map))
+
+        #Only look for new maps when the camera enters a new cell
+        pos = base.camera.get_pos(render)
+        camera_cell = self.get_cell_coords(pos)
+
+        if camera_cell == self.prefetch_cell:
+            return
+
+        self.prefetch_cell = camera_cell
+        distance = map_prefetch_distance.get_value()
+
+        for registry in (self.portals, self.gates):
+            for entity in registry:
+                map = os.path.normpath(os.path.join("./data/maps", 
+                    entity.dest))
+
+                if (map in self.map_cache or map in self.prefetching or
+                    (entity.model.get_pos() - pos).length() > distance):
+                    continue
+
+                self.prefetching.add(map)
+                self.prefetch_queue.put(map)
+
+    def run_prefetch(self):
+        """Prefetch the maps in the prefetch queue. This runs on a worker
+        thread.
+        """
+        while True:
+            map = self.prefetch_queue.get()
+            map_file = self.get_map_file(map)
+            map_data = load_map_data(map_file) if map_file is not None else None
+
+            if map_data is not None:
+                self.textures.preload(self.get_texture_manifest(map_data))
+
+            self.prefetched_queue.put((map, map_data))
+
+    def update_terrain(self):
+        """Update the level of detail of the terrain. If an update takes longer
+        than the frame budget, updates are spaced further apart until they fit
+        within it again.
+        """
+        clock = ClockObject.get_global_clock()
+        now = clock.get_real_time()
+
+        if now - self.terrain_update_time < self.terrain_update_interval:
+            return
+
+        self.terrain.update()
+        elapsed = clock.get_real_time() - now
+        self.terrain_update_time = now
+        budget = terrain_lod_budget.get_value()
+
+        if elapsed > budget:
+            self.terrain_update_interval = min(
+                max(self.terrain_update_interval * 2, 1 / 30), 
+                TERRAIN_MAX_UPDATE_INTERVAL)
+
+        elif elapsed < budget / 2:
+            self.terrain_update_interval /= 2
 
     def run_logic(self, task):
         """Run the logic for this world manager."""
+        #Update the terrain level of detail
+        if self.terrain is not None and self.terrain_lod:
+            self.update_terrain()
+
+        #Activate the portals and gates around the camera
+        self.triggers.update()
+
+        #Stream the scenery cells around the camera
+        if len(self.cells) > 0:
+            self.update_cells()
+
+            #Prefetch the maps that the camera may travel to. This waits until
+            #the current map is loaded, since unused prototypes are released
+            #once a load finishes.
+            if self.load_task is None:
+                self.update_prefetch()
+
         #Optimize the scenery
-        if self.is_dirty:
-            self.scenery.collect()
-            self.is_dirty = False
-            Logger.info("Optimized the scenery.")
+        self.collect_cells()
+        return Task.cont
+
+    def collect_cells(self):
+        """Combine the dirty scenery cells that are ready. Only a few cells are
+        combined each frame so that the cost is spread out.
+        """
+        #Report cells that were combined on the scenery thread
+        if scenery_collect_threaded:
+            while True:
+                try:
+                    cell, elapsed = self.collected_queue.get_nowait()
+
+                except Empty:
+                    break
+
+                cell.finish_collect()
+                self.report_collect(cell, elapsed)
+
+        #Find the cells that are ready to be combined
+        frame = ClockObject.get_global_clock().get_frame_count()
+        ready = [cell for cell in self.dirty_cells 
+            if not cell.is_collecting and cell.is_ready(frame)]
+
+        for cell in ready[:scenery_collects_per_frame.get_value()]:
+            self.dirty_cells.discard(cell)
+            cell.is_dirty = False
+
+            #Combine on the scenery thread?
+            if scenery_collect_threaded:
+                cell.is_collecting = True
+                self.collect_queue.put(cell)
+
+            else:
+                self.report_collect(cell, cell.collect())
+
+    def wait_for_collects(self):
+        """Wait until the scenery thread is done with every cell. Cells that it
+        hasn't started on yet are taken back and marked dirty again.
+        """
+        if not scenery_collect_threaded:
+            return
+
+        while True:
+            try:
+                cell = self.collect_queue.get_nowait()
+
+            except Empty:
+                break
+
+            cell.finish_collect()
+
+            if cell.is_active:
+                cell.mark_dirty()
+
+        while any([cell.is_collecting for cell in self.cells]):
+            cell, elapsed = self.collected_queue.get()
+            cell.finish_collect()
+            self.report_collect(cell, elapsed)
+
+    def report_collect(self, cell, elapsed):
+        """Record the time it took to combine a scenery cell."""
+        self.collect_count += 1
+        self.collect_time += elapsed
+        self.last_collect_time = elapsed
+        Logger.info("Optimized scenery cell '{}' in {:.2f} ms.".format(
+            cell.combiner.get_name(), elapsed * 1000))
+
+    def run_collect(self, task):
+        """Combine scenery cells on the scenery thread."""
+        try:
+            cell = self.collect_queue.get(timeout = .1)
+
+        except Empty:
+            return Task.cont
 
+        self.collected_queue.put((cell, cell.collect()))
         return Task.cont
@@ -0,0 +1,315 @@
+#!/usr/bin/python3
+"""Synthetic NeoIT-Py map generator."""
+
+import argparse
+import os
+import struct
+from xml.sax.saxutils import quoteattr
+import zlib
+
+import numpy as np
+
+#Constants
+#==============================================================================
+__author__ = "DylanCheetah"
+__copyright__ = "(c) 2020 by DylanCheetah"
+__license__ = "MIT"
+__version__ = "1.0.0"
+
+HEIGHTMAP_SIZE = 513 #the terrain is scaled for a 513x513 heightmap
+HEIGHTMAP_OCTAVES = 7 #number of noise layers summed to make the heightmap
+OBJECT_MESHES = ["rock", "rock_slab", "dead_tree", "grave", "pumpkin",
+    "beehive"]
+GROUP_MESHES = ["fir05_30", "fir06_30", "fir14_25", "acacia_tree",
+    "jungle_tree", "savannah_tree", "shrub", "farn", "farn2", "fern",
+    "shroom", "grass_patch"]
+GATE_MATERIAL = "Gate" #gates are drawn with a fixed material for now
+WRITE_CHUNK = 10000 #number of objects formatted at once
+
+
+#Classes
+#==============================================================================
+class MapGenerator(object):
+    """A basic app class."""
+    def make_heightmap(self, rng):
+        """Make a heightmap by summing layers of smoothed noise. The heights
+        are normalized to the range 0 to 1.
+        """
+        heights = np.zeros((HEIGHTMAP_SIZE, HEIGHTMAP_SIZE))
+        coords = np.linspace(0, 1, HEIGHTMAP_SIZE)
+
+        for octave in range(HEIGHTMAP_OCTAVES):
+            #Make a coarse grid of random values
+            cells = 2 ** (octave + 1)
+            grid = rng.random((cells + 1, cells + 1))
+
+            #Interpolate it up to the size of the heightmap
+            pos = coords * cells
+            lo = np.minimum(pos.astype(int), cells - 1)
+            offs = pos - lo
+            rows = (grid[lo] * (1 - offs)[:, np.newaxis] +
+                grid[lo + 1] * offs[:, np.newaxis])
+            heights += (rows[:, lo] * (1 - offs) + rows[:, lo + 1] * offs) / (
+                2 ** octave)
+
+        heights -= heights.min()
+        return heights / heights.max()
+
+    def get_heights(self, heights, x, y):
+        """Get the heights of the terrain at the given arrays of X and Y
+        coordinates. The first row of the heightmap is the far edge of the map.
+        """
+        scale = (HEIGHTMAP_SIZE - 1) / np.array(self.map_size[:2])
+        cols = np.clip(np.rint(x * scale[0]), 0, HEIGHTMAP_SIZE - 1).astype(
+            np.intp)
+        rows = np.clip(np.rint((HEIGHTMAP_SIZE - 1) - y * scale[1]), 0,
+            HEIGHTMAP_SIZE - 1).astype(np.intp)
+        return heights[rows, cols] * self.map_size[2]
+
+    def write_png(self, filename, heights):
+        """Write a heightmap as a 16-bit grayscale PNG image."""
+        #Convert the heights to big-endian rows that each start with filter
+        #type 0
+        size = heights.shape[0]
+        data = np.rint(heights * 65535).astype(">u2").view(np.uint8)
+        rows = np.hstack([np.zeros((size, 1), np.uint8),
+            data.reshape(size, -1)])
+
+        #Write the image
+        def chunk(tag, data):
+            return (struct.pack(">I", len(data)) + tag + data +
+                struct.pack(">I", zlib.crc32(tag + data)))
+
+        with open(filename, "wb") as f:
+            f.write(b"\x89PNG\r\n\x1a\n")
+            f.write(chunk(b"IHDR", struct.pack(">IIBBBBB", size, size, 16, 0,
+                0, 0, 0)))
+            f.write(chunk(b"IDAT", zlib.compress(rows.tobytes(), 6)))
+            f.write(chunk(b"IEND", b""))
+
+    def generate(self, args):
+        """Generate the entities of a map. Every random value is drawn in a
+        fixed order from a generator seeded with the given seed, so the same
+        arguments always produce the same map.
+        """
+        rng = np.random.default_rng(args.seed)
+        self.map_size = (args.size, args.size, args.height)
+        heights = self.make_heightmap(rng)
+
+        def random_pos(count):
+            x = rng.uniform(args.margin, args.size - args.margin, count)
+            y = rng.uniform(args.margin, args.size - args.margin, count)
+            return np.column_stack([x, y, self.get_heights(heights, x, y)])
+
+        #Portals and gates lead to the given maps or back to this one
+        destmaps = args.destmaps or [args.name]
+        portals = [(pos, destmaps[i % len(destmaps)])
+            for i, pos in enumerate(random_pos(args.portals))]
+        gates = [(pos, destmaps[i % len(destmaps)], destvec)
+            for i, (pos, destvec) in enumerate(zip(random_pos(args.gates),
+            random_pos(args.gates)))]
+
+        #Split the objects between single objects and object groups
+        group_count = int(args.objects * args.grouped)
+        object_count = args.objects - group_count
+        objects = (
+            rng.integers(0, len(OBJECT_MESHES), object_count),
+            random_pos(object_count),
+            rng.uniform(0, 360, object_count),
+            rng.uniform(.5, 2, object_count)
+            )
+
+        #Spread the grouped objects across the groups
+        groups = []
+        sizes = np.full(args.groups, group_count // max(args.groups, 1))
+        sizes[:group_count % max(args.groups, 1)] += 1
+
+        for i, size in enumerate(sizes.tolist()):
+            groups.append((
+                GROUP_MESHES[i % len(GROUP_MESHES)],
+                random_pos(size)[:, :2],
+                rng.uniform(0, 360, size),
+                rng.uniform(.5, 1.5, size)
+                ))
+
+        return (heights, random_pos(1)[0, :2], portals, gates, objects, groups)
+
+    def write_xml(self, filename, name, spawn_pos, portals, gates, objects,
+        groups):
+        """Write a map as NeoIT-Py XML. The XML is written a chunk of objects
+        at a time, so even maps with millions of objects are never held in
+        memory as text.
+        """
+        with open(filename, "w") as f:
+            #Terrain
+            f.write('<?xml version="1.0" ?>\n<world>\n')
+            f.write('    <terrain size="{} {} {}" spawnpos="{:.1f} {:.1f}" '
+                'heightmap={} material=""/>\n'.format(*self.map_size,
+                *spawn_pos, quoteattr(name + ".png")))
+
+            #Portals and gates
+            for pos, destmap in portals:
+                f.write('    <portal pos="{:.1f} {:.1f} {:.1f}" radius="50" '
+                    'destmap={}/>\n'.format(*pos, quoteattr(destmap)))
+
+            for pos, destmap, destvec in gates:
+                f.write('    <gate material={} pos="{:.1f} {:.1f} {:.1f}" '
+                    'destmap={} destvec="{:.1f} {:.1f} {:.1f}"/>\n'.format(
+                    quoteattr(GATE_MATERIAL), *pos, quoteattr(destmap),
+                    *destvec))
+
+            #Objects
+            meshes, pos, rot, scale = objects
+            line = ('    <object mesh="{}" pos="{:.1f} {:.1f} {:.1f}" '
+                'scale="{:.2f} {:.2f} {:.2f}" rot="{:.1f} 0 0" sound="" '
+                'material=""/>\n')
+
+            for start in range(0, len(meshes), WRITE_CHUNK):
+                rows = np.column_stack([pos[start:start + WRITE_CHUNK],
+                    scale[start:start + WRITE_CHUNK, np.newaxis].repeat(3, 1),
+                    rot[start:start + WRITE_CHUNK]]).tolist()
+                f.write("".join([line.format(OBJECT_MESHES[mesh], *row)
+                    for mesh, row in zip(
+                    meshes[start:start + WRITE_CHUNK].tolist(), rows)]))
+
+            #Object groups
+            line = ('        <object pos="{:.1f} {:.1f}" '
+                'scale="{:.2f} {:.2f} {:.2f}" rot="{:.1f} 0 0"/>\n')
+
+            for mesh, pos, rot, scale in groups:
+                f.write('    <objectgroup mesh={} material="">\n'.format(
+                    quoteattr(mesh)))
+
+                for start in range(0, len(pos), WRITE_CHUNK):
+                    rows = np.column_stack([pos[start:start + WRITE_CHUNK],
+                        scale[start:start + WRITE_CHUNK, np.newaxis].repeat(3,
+                        1), rot[start:start + WRITE_CHUNK]]).tolist()
+                    f.write("".join([line.format(*row) for row in rows]))
+
+                f.write("    </objectgroup>\n")
+
+            f.write("</world>\n")
+
+    def write_world(self, map_dir, name, spawn_pos, portals, gates, objects,
+        groups):
+        """Write a map in IT format, so the map upgrader can be run on it.
+        Positions are converted to Ogre coordinates, which the map upgrader
+        converts back.
+        """
+        depth = self.map_size[1]
+
+        #Write the Ogre terrain config
+        with open(os.path.join(map_dir, name + ".cfg"), "w") as f:
+            f.write("Heightmap.image={}.png\n".format(name))
+            f.write("CustomMaterialName=\n")
+            f.write("MaxHeight={}\n".format(self.map_size[2] - 210))
+
+        #Write the trees file
+        with open(os.path.join(map_dir, name + ".trees"), "w") as f:
+            line = "{:.1f} {:.1f};{:.2f};{:.1f}\n"
+
+            for mesh, pos, rot, scale in groups:
+                f.write("[{}.mesh;]\n".format(mesh))
+
+                for start in range(0, len(pos), WRITE_CHUNK):
+                    rows = np.column_stack([pos[start:start + WRITE_CHUNK, 0],
+                        depth - pos[start:start + WRITE_CHUNK, 1],
+                        scale[start:start + WRITE_CHUNK],
+                        rot[start:start + WRITE_CHUNK]]).tolist()
+                    f.write("".join([line.format(*row) for row in rows]))
+
+        #Write the world file
+        with open(os.path.join(map_dir, name + ".world"), "w") as f:
+            #Terrain
+            f.write("[Initialize]\n{}.cfg\n{}\n{}\n{:.1f} {:.1f}\n".format(
+                name, self.map_size[0], depth, *spawn_pos))
+
+            #Portals and gates
+            for pos, destmap in portals:
+                f.write("[Portal]\n{:.1f} {:.1f} {:.1f}\n50\n{}\n".format(
+                    pos[0], pos[2], depth - pos[1], destmap))
+
+            for pos, destmap, destvec in gates:
+                f.write("[Gate]\n{}\n{:.1f} {:.1f} {:.1f}\n{}\n"
+                    "{:.1f} {:.1f} {:.1f}\n".format(GATE_MATERIAL, pos[0],
+                    pos[2], depth - pos[1], destmap, destvec[0], destvec[2],
+                    depth - destvec[1]))
+
+            #Objects
+            meshes, pos, rot, scale = objects
+            section = ("[Object]\n{}.mesh\n{:.1f} {:.1f} {:.1f}\n"
+                "{:.2f} {:.2f} {:.2f}\n0 {:.1f} 0\n")
+
+            for start in range(0, len(meshes), WRITE_CHUNK):
+                rows = np.column_stack([pos[start:start + WRITE_CHUNK, 0],
+                    pos[start:start + WRITE_CHUNK, 2],
+                    depth - pos[start:start + WRITE_CHUNK, 1],
+                    scale[start:start + WRITE_CHUNK, np.newaxis].repeat(3, 1),
+                    rot[start:start + WRITE_CHUNK]]).tolist()
+                f.write("".join([section.format(OBJECT_MESHES[mesh], *row)
+                    for mesh, row in zip(
+                    meshes[start:start + WRITE_CHUNK].tolist(), rows)]))
+
+            #Object groups
+            f.write("[Trees]\n{}.trees\n".format(name))
+
+    def run(self):
+        """Run this app."""
+        #Display header
+        print("NeoIT-Py Map Generator v{}".format(__version__))
+        print(__copyright__)
+        print()
+
+        #Parse command-line arguments
+        argparser = argparse.ArgumentParser(description = __doc__)
+        argparser.add_argument("name")
+        argparser.add_argument("--output", default = ".",
+            help = "directory to create the map directory in")
+        argparser.add_argument("--objects", type = int, default = 10000,
+            help = "total number of objects")
+        argparser.add_argument("--grouped", type = float, default = .9,
+            help = "fraction of the objects placed in object groups")
+        argparser.add_argument("--groups", type = int, default = 8)
+        argparser.add_argument("--portals", type = int, default = 4)
+        argparser.add_argument("--gates", type = int, default = 4)
+        argparser.add_argument("--destmaps", nargs = "+",
+            help = "maps that portals and gates lead to (default: this map)")
+        argparser.add_argument("--size", type = float, default = 25000)
+        argparser.add_argument("--height", type = float, default = 2000)
+        argparser.add_argument("--margin", type = float, default = 100,
+            help = "distance to keep entities from the edge of the map")
+        argparser.add_argument("--seed", type = int, default = 0)
+        argparser.add_argument("--world", action = "store_true",
+            help = "also write the map in IT format for the map upgrader")
+        args = argparser.parse_args()
+
+        if args.groups < 1:
+            args.grouped = 0
+
+        #Generate the map
+        print("Generating '{}' with {} objects (seed {})...".format(args.name,
+            args.objects, args.seed))
+        heights, spawn_pos, portals, gates, objects, groups = self.generate(
+            args)
+
+        #Write the map
+        map_dir = os.path.join(args.output, args.name)
+        os.makedirs(map_dir, exist_ok = True)
+        self.write_png(os.path.join(map_dir, args.name + ".png"), heights)
+        self.write_xml(os.path.join(map_dir, args.name + ".xml"), args.name,
+            spawn_pos, portals, gates, objects, groups)
+        print("Map written to '{}'.".format(map_dir))
+
+        if args.world:
+            self.write_world(map_dir, args.name, spawn_pos, portals, gates,
+                objects, groups)
+            print("IT map written to '{}'.".format(os.path.join(map_dir,
+                args.name + ".world")))
+
+        print("done")
+
+
+#Entry Point
+#==============================================================================
+if __name__ == "__main__":
+    MapGenerator().run()
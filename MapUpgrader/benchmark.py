@@ -0,0 +1,160 @@
+#!/usr/bin/python3
+"""Map upgrader benchmarks."""
+
+import argparse
+from contextlib import redirect_stdout
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from xml.dom import minidom
+import xml.etree.ElementTree as etree
+
+import main as map_upgrader
+
+#Constants
+#==============================================================================
+GENERATOR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..",
+    "MapGenerator", "main.py")
+INTERIORS = "[Interior]\n0.5\nCaveMat\n[Interior]\n0.2 0.2 0.2\n1\nRoof\n"
+
+
+#Classes
+#==============================================================================
+class TreeWriter(object):
+    """A writer with the same interface as XMLWriter that builds the whole
+    document and prettifies it with minidom at the end, like the upgraders
+    used to.
+    """
+    def __init__(self, f, indent = "", addindent = "", newl = ""):
+        """Setup this tree writer."""
+        self.f = f
+        self.indent = indent
+        self.addindent = addindent
+        self.newl = newl
+        self.elems = []
+
+    def start(self, tag, attrib = {}):
+        """Start an element."""
+        if len(self.elems) == 0:
+            self.elems.append(etree.Element(tag, attrib))
+
+        else:
+            self.elems.append(etree.SubElement(self.elems[-1], tag, attrib))
+
+    def end(self):
+        """End the current element. The document is written once the root
+        element ends.
+        """
+        elem = self.elems.pop()
+
+        if len(self.elems) == 0:
+            xml = minidom.parseString(etree.tostring(elem))
+            xml.writexml(self.f, self.indent, self.addindent, self.newl)
+
+    def element(self, tag, attrib = {}):
+        """Add an element without children."""
+        self.start(tag, attrib)
+        self.end()
+
+    def write(self, elem):
+        """Add an ElementTree element and all of its children."""
+        self.start(elem.tag, elem.attrib)
+
+        for child in elem:
+            self.write(child)
+
+        self.end()
+
+    def flush(self, elem):
+        """Move the children of an ElementTree element to the document. The
+        children themselves are moved, so changes made to them later are
+        still written, like they were when the whole document was built
+        first.
+        """
+        self.elems[-1].extend(list(elem))
+        del elem[:]
+
+
+#Functions
+#==============================================================================
+def upgrade(world_file, writer, sidecar, trace):
+    """Upgrade a map with the given writer class and return the time it took,
+    the peak memory allocated while it ran if trace is True, and the XML it
+    wrote.
+    """
+    map_upgrader.XMLWriter = writer
+
+    if trace:
+        tracemalloc.start()
+
+    try:
+        with open(os.devnull, "w") as f, redirect_stdout(f):
+            start = time.perf_counter()
+            map_upgrader.MapUpgrader().upgrade_map(world_file, sidecar)
+            elapsed = time.perf_counter() - start
+
+    finally:
+        peak = tracemalloc.get_traced_memory()[1] if trace else None
+        tracemalloc.stop()
+
+    with open(world_file.replace(".world", ".xml"), "rb") as f:
+        return elapsed, peak, f.read()
+
+
+def main():
+    """Compare the streaming XML writer with minidom prettification on a
+    generated map, and with writing tree and bush instances to an instance
+    file.
+    """
+    argparser = argparse.ArgumentParser(description = __doc__)
+    argparser.add_argument("--objects", type = int, nargs = "+",
+        default = [10000, 100000])
+    argparser.add_argument("--seed", type = int, default = 0)
+    args = argparser.parse_args()
+    writers = [
+        ("minidom", TreeWriter, False),
+        ("streaming", map_upgrader.XMLWriter, False),
+        ("sidecar", map_upgrader.XMLWriter, True)
+        ]
+
+    print("{:>10} {:>10} {:>10} {:>12} {:>10}".format("objects", "writer",
+        "time s", "peak MiB", "output MiB"))
+
+    for count in args.objects:
+        with tempfile.TemporaryDirectory() as dir:
+            #Generate the map
+            subprocess.run([sys.executable, GENERATOR, "Bench", "--output",
+                dir, "--objects", str(count), "--seed", str(args.seed),
+                "--world"], stdout = subprocess.DEVNULL, check = True)
+            world_file = os.path.join(dir, "Bench", "Bench.world")
+            outputs = []
+
+            #Interior sections come after the terrain they add to
+            with open(world_file, "a") as f:
+                f.write(INTERIORS)
+
+            #Time each writer, then measure its memory in a separate run,
+            #since tracing memory slows it down
+            for name, writer, sidecar in writers:
+                elapsed, peak, xml = upgrade(world_file, writer, sidecar,
+                    False)
+                peak = upgrade(world_file, writer, sidecar, True)[1]
+
+                if not sidecar:
+                    outputs.append(xml)
+
+                print("{:>10} {:>10} {:>10.3f} {:>12.1f} {:>10.1f}".format(
+                    count, name, elapsed, peak / (1 << 20),
+                    len(xml) / (1 << 20)))
+
+            if any([xml != outputs[0] for xml in outputs]):
+                print("WARNING: The writers wrote different XML.")
+
+
+#Entry Point
+#==============================================================================
+if __name__ == "__main__":
+    main()
@@ -2,10 +2,23 @@
 """IT to NeoIT-Py map upgrader."""
 
 import argparse
+from concurrent.futures import as_completed, ProcessPoolExecutor
+from contextlib import ExitStack, redirect_stdout
+import hashlib
+import io
+import json
 import os
 import sys
-from xml.dom import minidom
+import time
 import xml.etree.ElementTree as etree
+import zlib
+
+import numpy as np
+
+#Shared modules
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    "..", "Common"))
+from xmlwriter import XMLWriter
 
 #Constants
 #==============================================================================
@@ -14,6 +27,14 @@ __copyright__ = "(c) 2020 by DylanCheetah"
 __license__ = "MIT"
 __version__ = "1.0.0"
 
+MANIFEST_VERSION = 2 #increment when the manifest format changes
+HASH_BLOCK_SIZE = 1 << 20 #number of bytes hashed at once
+CFG_BLOCK_SIZE = 1 << 16 #number of characters of config files read at once
+INSTANCE_DTYPE = np.dtype("<f4") #type of the values in instance files
+
+#Files whose code affects the output of the upgrader
+UPGRADER_FILES = [__file__, sys.modules[XMLWriter.__module__].__file__]
+
 
 #Classes
 #==============================================================================
@@ -56,12 +77,87 @@ class MapUpgrader(object):
         x, z, y = scale.split(" ")
         return "{} {} {}".format(x, y, z)
 
+    def parse_vecs(self, vecs, size):
+        """Parse a column of vectors into an array with the given number of
+        columns and return it along with the number of values in each vector.
+        Vectors with fewer values are padded with NaN and extra values are
+        dropped. Empty vectors have 0 values.
+        """
+        counts = np.array([0 if vec == "" else vec.count(" ") + 1 
+            for vec in vecs], int)
+        values = np.full((len(vecs), size), np.nan)
+
+        #Parse all vectors with the same number of values at once
+        for count in np.unique(counts[counts > 0]).tolist():
+            rows = np.flatnonzero(counts == count)
+            values[rows, :min(count, size)] = np.array(" ".join(
+                [vecs[row] for row in rows]).split(" "), np.float64).reshape(
+                -1, count)[:, :size]
+
+        return values, counts
+
+    def convert_instances(self, insts):
+        """Convert tree or bush instances in Ogre coordinates to positions,
+        rotations, and scales in Panda3D coordinates. Each column is converted
+        all at once, with the same results as convert_pos, convert_rot, and
+        convert_scale. Missing rotations and scales are 0, as they are when
+        they are left empty in the XML.
+        """
+        #Split the instances into columns
+        insts = [inst.split(";") for inst in insts]
+        pos, pos_counts = self.parse_vecs([inst[0] for inst in insts], 3)
+        scale, scale_counts = self.parse_vecs(
+            [inst[1] if len(inst) > 1 else "" for inst in insts], 3)
+        rot, rot_counts = self.parse_vecs(
+            [inst[2] if len(inst) > 2 else "" for inst in insts], 3)
+
+        if (np.any((pos_counts < 2) | (pos_counts > 3)) or 
+            np.any(scale_counts > 3) or 
+            np.any((rot_counts == 2) | (rot_counts > 3))):
+            raise ValueError("Invalid instance data.")
+
+        #Swap Y and Z and invert Y. The Z of 2 coordinate positions is NaN, so
+        #they are placed on the terrain.
+        rows = pos_counts == 3
+        pos[rows] = pos[rows][:, [0, 2, 1]]
+        pos[:, 1] = self.map_size[1] - pos[:, 1]
+
+        #Put the heading, pitch, and roll in the proper order
+        rows = rot_counts == 3
+        rot[rows] = rot[rows][:, [1, 0, 2]]
+        rot[rot_counts == 1, 1:] = 0
+        rot[rot_counts == 0] = 0
+
+        #Expand single and double coordinate scales and swap Y and Z
+        for count, order in ((1, [0, 0, 0]), (2, [0, 1, 0]), (3, [0, 2, 1])):
+            rows = scale_counts == count
+            scale[rows] = scale[rows][:, order]
+
+        scale[scale_counts == 0] = 0
+        return np.stack([pos, rot, scale])
+
+    def write_instances(self, insts):
+        """Convert tree or bush instances and write them to the instance file
+        as 3 columns: positions, rotations, and scales. Return the attributes
+        of the object group that reference them.
+        """
+        data = self.convert_instances(insts).astype(INSTANCE_DTYPE).tobytes()
+        offset = self.instances.tell()
+        self.instances.write(data)
+        return {
+            "instances": os.path.basename(self.instance_file),
+            "offset": str(offset),
+            "count": str(len(insts)),
+            "crc": str(zlib.crc32(data))
+            }
+
     def load_ogre_terrain(self, terrain_file):
         """Load an Ogre terrain config file."""
         #Open the terrain config file
         heightmap = ""
         material = ""
         height = "300"
+        self.inputs.append(terrain_file)
 
         with open(terrain_file, "r") as f:
             #Find the heightmap and material file entries
@@ -80,24 +176,59 @@ class MapUpgrader(object):
 
         return (heightmap, material, float(height) + 210)
 
+    def split_it_lines(self, data):
+        """Split part of an IT config file into lines. Empty lines and "#"
+        lines are skipped and "]" is ignored.
+        """
+        return [line for line in data.replace("]", "").split("\n")
+            if line != "" and line != "#"]
+
     def load_it_cfg(self, world_file):
-        """Load an IT config file.
+        """Load an IT config file and yield each of its sections as a list of
+        lines.
         
         Note: The normal config parser is unable to load IT config files like
         .world due to duplicate sections and lack of keys. The Ogre terrain files
         can however be loaded with the normal config parser.
+
+        Each "[" starts a new section, so the first line of a section is its
+        header. The file is read a block at a time and each section is yielded
+        as soon as it ends, so only one section is held in memory at once.
         """
         #Read the map data
+        self.inputs.append(world_file)
+
         with open(world_file, "r") as f:
-            data = f.read()
+            section = []
+            tail = ""
 
-        #Parse the map data
-        sections = [[line for line in section.replace("]", "").split("\n") if line != "" and line != "#"] for section in data.split("[") if section != ""]
-        return sections
+            for block in iter(lambda: f.read(CFG_BLOCK_SIZE), ""):
+                #Each "[" ends the current section and starts a new one
+                parts = (tail + block).split("[")
+
+                for part in parts[:-1]:
+                    section += self.split_it_lines(part)
+
+                    if len(section) > 0:
+                        yield section
+
+                    section = []
+
+                #Keep the last partial line for the next block
+                end = parts[-1].rfind("\n") + 1
+                section += self.split_it_lines(parts[-1][:end])
+                tail = parts[-1][end:]
+
+            #Last section
+            section += self.split_it_lines(tail)
+
+            if len(section) > 0:
+                yield section
 
     def load_it_trees(self, tree_file, elm):
-        """Load an IT tree file and add the trees as children of the given XML 
-        element.
+        """Load an IT tree file and write the trees as children of the given XML 
+        element. The element must be the element being written. Each tree is
+        written as soon as it is converted.
         """
         #Load the trees
         sections = self.load_it_cfg(tree_file)
@@ -109,11 +240,21 @@ class MapUpgrader(object):
             material = tree[1] if len(tree) > 1 else ""
 
             #Add a new tree group to the XML
-            tree_group = etree.SubElement(elm, "objectgroup", {
+            tree_group = {
                 "mesh": mesh,
                 "material": material
-                })
-            print("TreeGroup: {}".format(tree_group.attrib))
+                }
+            self.writer.flush(elm)
+
+            #Write the trees to the instance file?
+            if self.instances is not None:
+                tree_group.update(self.write_instances(section[1:]))
+                self.writer.element("objectgroup", tree_group)
+                print("TreeGroup: {}".format(tree_group))
+                continue
+
+            self.writer.start("objectgroup", tree_group)
+            print("TreeGroup: {}".format(tree_group))
 
             #Parse the tree data
             skip = True
@@ -132,16 +273,20 @@ class MapUpgrader(object):
                     rot = self.convert_rot(inst_data[2]) if len(inst_data) > 2 else ""
 
                     #Add the tree to the XML
-                    tree_inst = etree.SubElement(tree_group, "object", {
+                    tree_inst = {
                         "pos": pos,
                         "scale": scale,
                         "rot": rot
-                        })
-                    print("    Tree: {}".format(tree_inst.attrib))
+                        }
+                    self.writer.element("object", tree_inst)
+                    print("    Tree: {}".format(tree_inst))
+
+            self.writer.end()
 
     def load_it_bushes(self, bush_file, elm):
-        """Load an IT bush file and add the bushes as children of the given XML 
-        element.
+        """Load an IT bush file and write the bushes as children of the given
+        XML element. The element must be the element being written. Each bush
+        is written as soon as it is converted.
         """
         #Load the bush
         sections = self.load_it_cfg(bush_file)
@@ -153,11 +298,21 @@ class MapUpgrader(object):
             material = bush[1] if len(bush) > 1 else ""
 
             #Add a new bush group to the XML
-            bush_group = etree.SubElement(elm, "objectgroup", {
+            bush_group = {
                 "mesh": mesh,
                 "material": material
-                })
-            print("BushGroup: {}".format(bush_group.attrib))
+                }
+            self.writer.flush(elm)
+
+            #Write the bushs to the instance file?
+            if self.instances is not None:
+                bush_group.update(self.write_instances(section[1:]))
+                self.writer.element("objectgroup", bush_group)
+                print("BushGroup: {}".format(bush_group))
+                continue
+
+            self.writer.start("objectgroup", bush_group)
+            print("BushGroup: {}".format(bush_group))
 
             #Parse the bush data
             skip = True
@@ -176,12 +331,15 @@ class MapUpgrader(object):
                     rot = self.convert_rot(inst_data[2]) if len(inst_data) > 2 else ""
 
                     #Add the bush to the XML
-                    bush_inst = etree.SubElement(bush_group, "object", {
+                    bush_inst = {
                         "pos": pos,
                         "scale": scale,
                         "rot": rot
-                        })
-                    print("    Bush: {}".format(bush_inst.attrib))
+                        }
+                    self.writer.element("object", bush_inst)
+                    print("    Bush: {}".format(bush_inst))
+
+            self.writer.end()
 
     def load_it_critters(self, critter_file, elm):
         """Load an IT critter file and add the data as children of the given XML 
@@ -235,18 +393,34 @@ class MapUpgrader(object):
                 print("WARNING: Unknown critter section '{}' encountered.".format(
                     section[0]))
 
-    def upgrade_map(self, world_file):
-        """Upgrade an IT map to NeoIT-Py format."""
-        print("Upgrading '{}'...".format(world_file))
-
-        #Upgrade the old map
-        map_dir = os.path.dirname(world_file)
-        self.map_size = (0, 0)
-        sections = self.load_it_cfg(world_file)
-        xml = etree.ElementTree()
-        xml._setroot(etree.Element("world"))
-        root = xml.getroot()
-
+    def add_interior(self, section, elm):
+        """Add the data of an interior section as a child of the given XML
+        element.
+        """
+        #Parse interior data
+        if len(section) > 3:
+            color = section[1]
+            height = section[2]
+            material = section[3]
+
+        else:
+            color = ""
+            height = section[1]
+            material = section[2]
+
+        #Add interior data to XML
+        interior = etree.SubElement(elm, "interior", {
+            "color": color,
+            "height": height,
+            "material": material
+            })
+        print("Interior: {}".format(interior.attrib))
+
+    def upgrade_sections(self, sections, map_dir, root, interiors):
+        """Upgrade the sections of an IT map. The XML of each section is
+        written as soon as the section is upgraded. The interior sections of
+        the map are added to the terrain when it is upgraded.
+        """
         for section in sections:
             #Initialize Section
             if section[0] == "Initialize":
@@ -270,6 +444,11 @@ class MapUpgrader(object):
                     })
                 print("Terrain: {}".format(terrain.attrib))
 
+                #Add the interior data of the map to the terrain now, since
+                #the terrain is written as soon as this section ends
+                for interior in interiors:
+                    self.add_interior(interior, terrain)
+
             #Portal Section
             elif section[0] == "Portal":
                 #Parse portal data
@@ -371,24 +550,8 @@ class MapUpgrader(object):
 
             #Interior Section
             elif section[0] == "Interior":
-                #Parse interior data
-                if len(section) > 3:
-                    color = section[1]
-                    height = section[2]
-                    material = section[3]
-
-                else:
-                    color = ""
-                    height = section[1]
-                    material = section[2]
-
-                #Add interior data to XML
-                interior = etree.SubElement(terrain, "interior", {
-                    "color": color,
-                    "height": height,
-                    "material": material
-                    })
-                print("Interior: {}".format(interior.attrib))
+                #Interior sections were added to the terrain along with it
+                pass
 
             #Light Section
             elif section[0] == "Light":
@@ -597,14 +760,213 @@ class MapUpgrader(object):
                 print("WARNING: Unknown world section '{}' encountered.".format(
                     section[0]))
 
-        #Save prettified XML
-        xml = minidom.parseString(etree.tostring(root))
-        
-        with open(world_file.replace(".world", ".xml"), "w") as f:
-            xml.writexml(f, addindent = "    ", newl = "\n")
+            #Write the XML of the section
+            self.writer.flush(root)
+
+    def upgrade_map(self, world_file, sidecar = False):
+        """Upgrade an IT map to NeoIT-Py format. If sidecar is True, tree and
+        bush instances are written to a binary instance file next to the XML
+        instead of to the XML.
+        """
+        print("Upgrading '{}'...".format(world_file))
+
+        #Upgrade the old map
+        map_dir = os.path.dirname(world_file)
+        self.map_size = (0, 0)
+        self.inputs = []
+        sections = self.load_it_cfg(world_file)
+        root = etree.Element("world")
+
+        #Interior sections add to the terrain, which may come before them, so
+        #find them first
+        interiors = [section for section in self.load_it_cfg(world_file)
+            if section[0] == "Interior"]
+        self.inputs = []
+
+        #Write the output to temporary files first, so that a failed upgrade
+        #never leaves a partial map behind
+        self.outputs = [world_file.replace(".world", ".xml")]
+        self.instance_file = world_file.replace(".world", ".instances")
+        self.instances = None
+
+        if sidecar:
+            self.outputs.append(self.instance_file)
+
+        try:
+            with ExitStack() as files:
+                f = files.enter_context(open(self.outputs[0] + ".tmp", "w"))
+                self.writer = XMLWriter(f, addindent = "    ", newl = "\n")
+
+                if sidecar:
+                    self.instances = files.enter_context(open(
+                        self.instance_file + ".tmp", "wb"))
+
+                self.writer.start(root.tag)
+                self.upgrade_sections(sections, map_dir, root, interiors)
+                self.writer.end()
+
+        except Exception:
+            for filename in self.outputs:
+                if os.path.exists(filename + ".tmp"):
+                    os.remove(filename + ".tmp")
+
+            raise
+
+        finally:
+            self.instances = None
+
+        for filename in self.outputs:
+            os.replace(filename + ".tmp", filename)
 
         print("done")
 
+    def find_maps(self, path):
+        """Find the world files of the maps at the given path. A map directory
+        gives its world file and any other directory is scanned for the world
+        files of every map inside it.
+        """
+        #World file?
+        if not os.path.isdir(path):
+            return [path]
+
+        #Map directory?
+        world_file = os.path.join(path, os.path.basename(
+            os.path.normpath(path)) + ".world")
+
+        if os.path.exists(world_file):
+            return [world_file]
+
+        #Scan the directory for maps
+        world_files = []
+
+        for dir, dirs, files in os.walk(path):
+            dirs.sort()
+            world_files += [os.path.join(dir, file) for file in sorted(files)
+                if os.path.splitext(file)[1] == ".world"]
+
+        return world_files
+
+    def get_file_hash(self, filename):
+        """Get the SHA-256 hash of the contents of a file. Upon failure, return
+        None.
+        """
+        hash = hashlib.sha256()
+
+        try:
+            with open(filename, "rb") as f:
+                for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b""):
+                    hash.update(block)
+
+        except OSError:
+            return None
+
+        return hash.hexdigest()
+
+    def get_upgrader_hash(self):
+        """Get a hash of the code of this upgrader, including the shared
+        modules it writes its output with. Upon failure, return None.
+        """
+        hash = hashlib.sha256()
+
+        for filename in UPGRADER_FILES:
+            digest = self.get_file_hash(filename)
+
+            if digest is None:
+                return None
+
+            hash.update(digest.encode("ascii"))
+
+        return hash.hexdigest()
+
+    def get_manifest_file(self, world_file):
+        """Get the manifest file of a map."""
+        return os.path.splitext(world_file)[0] + ".manifest"
+
+    def is_up_to_date(self, world_file, sidecar = False):
+        """Check whether the output of a map was upgraded from the current
+        contents of every file the map depends on by the current upgrader
+        with the same options.
+        """
+        #Load the manifest
+        try:
+            with open(self.get_manifest_file(world_file), "r") as f:
+                manifest = json.load(f)
+
+        except (OSError, ValueError):
+            return False
+
+        if (manifest.get("version") != MANIFEST_VERSION or 
+            manifest.get("upgrader") != self.get_upgrader_hash() or
+            manifest.get("sidecar") != sidecar):
+            return False
+
+        #Check each output and input
+        map_dir = os.path.dirname(world_file)
+        files = dict(manifest.get("inputs", {}))
+        files.update(manifest.get("outputs", {}))
+
+        for filename, hash in files.items():
+            if (hash is None or 
+                self.get_file_hash(os.path.join(map_dir, filename)) != hash):
+                return False
+
+        return True
+
+    def write_manifest(self, world_file):
+        """Write the manifest of a map. The manifest records the hash of every
+        file that the last upgrade of the map read and wrote.
+        """
+        map_dir = os.path.dirname(world_file)
+        manifest = {
+            "version": MANIFEST_VERSION,
+            "upgrader": self.get_upgrader_hash(),
+            "sidecar": self.instance_file in self.outputs,
+            "inputs": {os.path.relpath(filename, map_dir or "."):
+                self.get_file_hash(filename) for filename in self.inputs},
+            "outputs": {os.path.relpath(filename, map_dir or "."):
+                self.get_file_hash(filename) for filename in self.outputs}
+            }
+
+        with open(self.get_manifest_file(world_file), "w") as f:
+            json.dump(manifest, f, indent = 4, sort_keys = True)
+            f.write("\n")
+
+    def process_map(self, world_file, quiet = False, force = False,
+        sidecar = False):
+        """Upgrade a map and return the time it took and the error that
+        stopped it, if any. Maps that are up to date are skipped unless force
+        is True. If quiet is True, the output of the upgrade is captured and
+        returned instead of printed, so that maps upgraded in parallel do not
+        mix their output. Sidecar is passed on to upgrade_map.
+        """
+        log = io.StringIO()
+        error = None
+        skipped = False
+        start = time.perf_counter()
+
+        with redirect_stdout(log if quiet else sys.stdout):
+            #Skip maps that are up to date
+            if not force and self.is_up_to_date(world_file, sidecar):
+                print("'{}' is up to date.".format(world_file))
+                skipped = True
+
+            #Upgrade the map and record what it was upgraded from
+            else:
+                try:
+                    self.upgrade_map(world_file, sidecar)
+                    self.write_manifest(world_file)
+
+                except Exception as e:
+                    error = "{}: {}".format(type(e).__name__, e)
+
+        return {
+            "map": world_file,
+            "time": time.perf_counter() - start,
+            "error": error,
+            "skipped": skipped,
+            "log": log.getvalue()
+            }
+
     def run(self):
         """Run this app."""
         #Display header
@@ -614,23 +976,101 @@ class MapUpgrader(object):
 
         #Parse command-line arguments
         argparser = argparse.ArgumentParser(description = __doc__)
-        argparser.add_argument("maps", nargs = "+")
+        argparser.add_argument("maps", nargs = "+",
+            help = "world files, map directories, or directories of maps")
+        argparser.add_argument("-j", "--jobs", type = int, default = 1,
+            help = "number of maps to upgrade at once (0 = one per CPU)")
+        argparser.add_argument("-f", "--force", action = "store_true",
+            help = "upgrade maps even if they are up to date")
+        argparser.add_argument("--sidecar", action = "store_true",
+            help = "write tree and bush instances to a binary instance file")
         args = argparser.parse_args()
+        jobs = args.jobs if args.jobs > 0 else os.cpu_count() or 1
+
+        #Find the world files
+        world_files = []
+        results = {}
 
         for map in args.maps:
-            if os.path.isdir(map):
-                #Build path to world file
-                map = os.path.join(map, os.path.basename(map) + ".world")
+            for world_file in self.find_maps(map):
+                world_file = os.path.normpath(world_file)
+
+                #Skip maps that were already given
+                if world_file in world_files or world_file in results:
+                    continue
+
+                if (os.path.splitext(world_file)[1] == ".world" and 
+                    os.path.exists(world_file)):
+                    world_files.append(world_file)
+
+                else:
+                    print("ERROR: Failed to process map '{}'".format(
+                        world_file))
+                    results[world_file] = {
+                        "map": world_file,
+                        "time": 0,
+                        "error": "File not found." if not os.path.exists(
+                            world_file) else "Not a world file.",
+                        "skipped": False,
+                        "log": ""
+                        }
+
+        #Upgrade the maps
+        start = time.perf_counter()
+
+        if jobs == 1 or len(world_files) < 2:
+            for world_file in world_files:
+                results[world_file] = self.process_map(world_file,
+                    force = args.force, sidecar = args.sidecar)
+
+        else:
+            with ProcessPoolExecutor(min(jobs, len(world_files))) as pool:
+                futures = [pool.submit(self.process_map, world_file, True,
+                    args.force, args.sidecar) for world_file in world_files]
+
+                #Print the output of each map as it finishes
+                for future in as_completed(futures):
+                    result = future.result()
+                    results[result["map"]] = result
+                    print(result["log"], end = "")
+
+        elapsed = time.perf_counter() - start
+
+        #Display summary
+        failed = [result for result in results.values()
+            if result["error"] is not None]
+        skipped = [result for result in results.values() if result["skipped"]]
+        print()
+        print("Summary")
+        print("=======")
 
-            if (os.path.splitext(map)[1] == ".world" and 
-                os.path.exists(map)):
-                #Upgrade the map
-                self.upgrade_map(map)
+        for result in sorted(results.values(), key = lambda result: 
+            -result["time"]):
+            if result["error"] is not None:
+                status = "FAILED "
+
+            elif result["skipped"]:
+                status = "skipped"
 
             else:
-                print("ERROR: Failed to process map '{}'".format(map))
+                status = "ok     "
+
+            print("{:>9.3f}s  {}  {}".format(result["time"], status,
+                result["map"]))
+
+            if result["error"] is not None:
+                print("            {}".format(result["error"]))
+
+        print()
+        print("Upgraded {} of {} maps ({} up to date) in {:.3f}s with {} "
+            "jobs.".format(len(results) - len(failed) - len(skipped),
+            len(results), len(skipped), elapsed, jobs))
+
+        if len(failed) > 0:
+            sys.exit(1)
 
 
 #Entry Point
 #==============================================================================
-MapUpgrader().run()
\ No newline at end of file
+if __name__ == "__main__":
+    MapUpgrader().run()
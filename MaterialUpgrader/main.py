@@ -3,9 +3,14 @@
 
 import argparse
 import os
-from xml.dom import minidom
+import sys
 import xml.etree.ElementTree as etree
 
+#Shared modules
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    "..", "Common"))
+from xmlwriter import XMLWriter
+
 
 #Constants
 #==============================================================================
@@ -191,29 +196,41 @@ class MaterialConverter(object):
         #Upgrade the material
         print("Upgrading material '{}'...".format(material))
         self.root = etree.Element("materials")
+        xml_file = material.replace(".material", "_mat.xml")
+
+        #Write the XML to a temporary file first, so that a failed upgrade
+        #never leaves a partial file behind
+        try:
+            with open(material, "r") as f, open(xml_file + ".tmp", "w") as xml:
+                #Get file iterator
+                self.lines = iter(f)
 
-        with open(material, "r") as f:
-            #Get file iterator
-            self.lines = iter(f)
+                #Write each material as soon as it is upgraded
+                writer = XMLWriter(xml, indent = "    ", newl = "\n")
+                writer.start(self.root.tag)
+
+                for line in self.lines:
+                    #Strip line
+                    line = line.strip()
 
-            for line in self.lines:
-                #Strip line
-                line = line.strip()
+                    #New material?
+                    if line.startswith("material"):
+                        self.parse_material(line.split(" ")[1])
+                        writer.flush(self.root)
 
-                #New material?
-                if line.startswith("material"):
-                    self.parse_material(line.split(" ")[1])
+                    #Unknown line
+                    else:
+                        print("WARNING: Unknown line '{}'.".format(line))
 
-                #Unknown line
-                else:
-                    print("WARNING: Unknown line '{}'.".format(line))
+                writer.end()
 
-        #Save prettified XML
-        xml = minidom.parseString(etree.tostring(self.root))
+        except Exception:
+            if os.path.exists(xml_file + ".tmp"):
+                os.remove(xml_file + ".tmp")
 
-        with open(material.replace(".material", "_mat.xml"), "w") as f:
-            xml.writexml(f, indent = "    ", newl = "\n")
+            raise
 
+        os.replace(xml_file + ".tmp", xml_file)
         print("done")
 
     def run(self):